@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""benchmarks of the dobiss api against a fake NXT server
+
+python benchmarks/benchmark.py --modules 40 --channels 12
+"""
+
+import argparse
+import asyncio
+import gc
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import dobissapi  # noqa: E402
+from dobissapi.fakenxt import FakeNXT  # noqa: E402
+
+
+def percentiles(samples, points=(50, 90, 99)):
+    samples = sorted(samples)
+    if not samples:
+        return {p: 0.0 for p in points}
+    return {
+        p: samples[min(len(samples) - 1, int(len(samples) * p / 100))] for p in points
+    }
+
+
+def report(name, count, elapsed, samples=None):
+    line = f"{name:<32} {count:>8} in {elapsed:8.3f}s  {count / elapsed:12.1f}/s"
+    if samples:
+        pct = percentiles(samples)
+        line += "  " + "  ".join(
+            f"p{p} {value * 1e6:8.1f}us" for p, value in pct.items()
+        )
+    print(line)
+
+
+async def bench_discovery(nxt, repeat):
+    dobiss = dobissapi.DobissAPI(nxt.secret, "localhost", False)
+    start = time.perf_counter()
+    dobiss._get_dobiss_devices(nxt.discovery)
+    report("discovery (cold)", 1, time.perf_counter() - start)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        dobiss._get_dobiss_devices(nxt.discovery)
+    report("discovery (unchanged)", repeat, time.perf_counter() - start)
+
+
+async def bench_memory(nxt):
+    dobiss = dobissapi.DobissAPI(nxt.secret, "localhost", False)
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    devices = dobiss._get_dobiss_devices(nxt.discovery)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    print(
+        f"{'memory per entity':<32} {len(devices):>8} entities  {size / len(devices):10.0f} bytes"
+    )
+
+
+async def bench_dispatch(nxt, messages):
+    dobiss = dobissapi.DobissAPI(nxt.secret, "localhost", False)
+    dobiss._get_dobiss_devices(nxt.discovery)
+    frames = [nxt.random_change() for _ in range(messages)]
+    frames = [
+        {address: list(line)} for frame in frames for address, line in frame.items()
+    ]
+    samples = []
+    start = time.perf_counter()
+    for frame in frames:
+        t = time.perf_counter()
+        await dobiss.update_from_status(frame)
+        samples.append(time.perf_counter() - t)
+    report("update_from_status", messages, time.perf_counter() - start, samples)
+
+
+async def bench_websocket(nxt, messages):
+    host = await nxt.start()
+    dobiss = dobissapi.DobissAPI(nxt.secret, host, False)
+    try:
+        await dobiss.discovery()
+        connected = asyncio.Event()
+        dobiss.register_connection_callback(
+            lambda state: (
+                connected.set() if state == dobissapi.DOBISS_WS_CONNECTED else None
+            )
+        )
+        await dobiss.dobiss_monitor()
+        await asyncio.wait_for(connected.wait(), 10)
+        # make sure every pushed frame changes exactly one entity
+        await dobiss.update_all()
+        received = 0
+        done = asyncio.Event()
+        expected = messages
+
+        def callback():
+            nonlocal received
+            received += 1
+            if received >= expected:
+                done.set()
+
+        for device in dobiss.get_devices_by_type(dobissapi.DobissOutput):
+            device.register_callback(callback)
+
+        # throughput: push all frames at once
+        start = time.perf_counter()
+        for _ in range(messages):
+            await nxt.push(nxt.random_change())
+        try:
+            await asyncio.wait_for(done.wait(), 30)
+        except asyncio.TimeoutError:
+            print(f"only {received} of {messages} websocket updates received")
+        report("websocket push (burst)", received, time.perf_counter() - start)
+
+        # latency: push one frame at a time, and wait for its callback
+        samples = []
+        start = time.perf_counter()
+        for _ in range(min(messages, 500)):
+            received = 0
+            expected = 1
+            done.clear()
+            t = time.perf_counter()
+            await nxt.push(nxt.random_change())
+            await asyncio.wait_for(done.wait(), 10)
+            samples.append(time.perf_counter() - t)
+        report(
+            "websocket push to callback",
+            len(samples),
+            time.perf_counter() - start,
+            samples,
+        )
+    finally:
+        dobiss.stop_monitoring()
+        await nxt.stop()
+        await dobiss.end_session()
+
+
+async def bench_actions(nxt, count, queue):
+    nxt.actions.clear()
+    host = await nxt.start()
+    dobiss = dobissapi.DobissAPI(nxt.secret, host, False)
+    try:
+        await dobiss.discovery()
+        if queue:
+            dobiss.enable_action_queue()
+        outputs = dobiss.get_devices_by_type(dobissapi.DobissOutput)
+        calls = [outputs[i % len(outputs)] for i in range(count)]
+        samples = []
+
+        async def timed(device):
+            t = time.perf_counter()
+            await device.toggle()
+            samples.append(time.perf_counter() - t)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(timed(device) for device in calls))
+        name = "actions (queued)" if queue else "actions"
+        report(name, count, time.perf_counter() - start, samples)
+        print(f"{'':<32} {len(nxt.actions):>8} requests received by the server")
+    finally:
+        await dobiss.disable_action_queue()
+        await nxt.stop()
+        await dobiss.end_session()
+
+
+async def main(args):
+    def create_nxt():
+        return FakeNXT(
+            modules=args.modules,
+            channels=args.channels,
+            screens=args.screens,
+            zones=args.zones,
+            seed=1,
+        )
+
+    nxt = create_nxt()
+    print(
+        f"installation: {args.modules} modules x {args.channels} channels, "
+        f"{args.screens} screens, {args.zones} zones"
+    )
+    await bench_discovery(nxt, args.repeat)
+    await bench_memory(nxt)
+    await bench_dispatch(nxt, args.messages)
+    await bench_websocket(create_nxt(), args.messages)
+    await bench_actions(create_nxt(), args.actions, queue=False)
+    await bench_actions(create_nxt(), args.actions, queue=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--modules", type=int, default=20)
+    parser.add_argument("--channels", type=int, default=12)
+    parser.add_argument("--screens", type=int, default=4)
+    parser.add_argument("--zones", type=int, default=4)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--actions", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=100)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(main(args))
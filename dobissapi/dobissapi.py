@@ -1,18 +1,91 @@
 # -*- coding: utf-8 -*-
 import asyncio
+import contextlib
+import hashlib
+import inspect
+import json
 import logging
+import math
+import os
+import random
+import ssl
+import time
+from array import array
+from collections import deque
 from datetime import datetime
-from datetime import timedelta
 
 import aiohttp
 import jwt
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
 logger = logging.getLogger(__name__)
 # logger.setLevel(logging.DEBUG)
 logger.setLevel(logging.INFO)
 
 DEF_DISCOVERY_INTERVAL = 60.0
 MIN_DISCOVERY_INTERVAL = 10.0
+DEF_POOL_LIMIT = 10
+DEF_POOL_LIMIT_PER_HOST = 0
+DEF_MANAGER_POOL_LIMIT = 100
+DEF_MANAGER_POOL_LIMIT_PER_HOST = 10
+DEF_DISCOVERY_STAGGER = 1.0
+DISCOVERY_CACHE_VERSION = 1
+DEF_KEEPALIVE_TIMEOUT = 60.0
+DEF_DNS_CACHE_TTL = 300
+DEF_ACTION_FLUSH_WINDOW = 0.05
+DEF_ACTION_MAX_IN_FLIGHT = 4
+DEF_APPLY_MAX_PARALLEL = 4
+DEF_CALLBACK_QUEUE_SIZE = 1000
+DEF_EVENT_QUEUE_SIZE = 1000
+DEF_POLL_MIN_INTERVAL = 1.0
+DEF_POLL_MAX_INTERVAL = 30.0
+DEF_POLL_HOT_WINDOW = 60.0
+DEF_REFRESH_WINDOW = 0.01
+DEF_HISTORY_SIZE = 3600
+DEF_OPTIMISTIC_TIMEOUT = 5.0
+DEF_LIMIT_INITIAL = 4
+DEF_LIMIT_MIN = 1
+DEF_LIMIT_MAX = 32
+DEF_LIMIT_LATENCY_TARGET = 0.5
+DEF_LIMIT_BACKOFF = 0.5
+DEF_BREAKER_THRESHOLD = 5
+DEF_BREAKER_RESET_TIMEOUT = 30.0
+DEF_METRICS_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+DEF_TOKEN_LIFETIME = 24 * 3600
+DEF_TOKEN_REFRESH_MARGIN = 4 * 3600
+DEF_WEBSOCKET_HEARTBEAT = 30.0
+DEF_RECONNECT_MIN_DELAY = 1.0
+DEF_RECONNECT_MAX_DELAY = 60.0
+DEF_RECONNECT_MAX_EXPONENT = 16
+
+# websocket connection states
+DOBISS_WS_CONNECTING = "connecting"
+DOBISS_WS_CONNECTED = "connected"
+DOBISS_WS_DISCONNECTED = "disconnected"
+
+# circuit breaker states of the request limiter
+DOBISS_CIRCUIT_CLOSED = "closed"
+DOBISS_CIRCUIT_OPEN = "open"
+DOBISS_CIRCUIT_HALF_OPEN = "half_open"
+
+# results of apply_state, per entity
+DOBISS_APPLY_UNCHANGED = "unchanged"
+DOBISS_APPLY_SENT = "sent"
+DOBISS_APPLY_FAILED = "failed"
+DOBISS_APPLY_NOT_FOUND = "not_found"
+
+# what an event subscription does when its queue is full
+DOBISS_OVERFLOW_DROP_OLDEST = "drop_oldest"
+DOBISS_OVERFLOW_COALESCE = "coalesce"
+DOBISS_OVERFLOW_BLOCK = "block"
 
 # dobiss icon_id mapping
 DOBISS_LIGHT = 0
@@ -77,15 +150,513 @@ DOBISS_TYPE_AUDIO = 205
 DOBISS_TYPE_FLAG = 206
 
 
+def get_default_json_decoder():
+    """Return the fastest available json decoder: orjson or msgspec when installed,
+    the json module otherwise. The decoder accepts bytes and str, and raises
+    ValueError on invalid json."""
+    if orjson is not None:
+        return orjson.loads
+    if msgspec is not None:
+        decoder = msgspec.json.Decoder()
+
+        def decode(data):
+            try:
+                return decoder.decode(data)
+            except msgspec.DecodeError as error:
+                raise ValueError(str(error)) from error
+
+        return decode
+    return json.loads
+
+
+# newer aiohttp versions can pass websocket text frames as bytes, without decoding them to str
+_WS_DECODE_TEXT = (
+    "decode_text" in inspect.signature(aiohttp.ClientSession.ws_connect).parameters
+)
+
+# shared no-op span, used when metrics are disabled
+_NO_SPAN = contextlib.nullcontext()
+
+
+class DobissUnavailableError(Exception):
+    """raised without contacting the dobiss server while it is considered unhealthy"""
+
+
+class DobissSpan:
+    """measures the duration of a block of code into a histogram of DobissMetrics,
+    and counts the exceptions raised in the block"""
+
+    __slots__ = ("_metrics", "_name", "_labels", "_start")
+
+    def __init__(self, metrics, name, labels):
+        self._metrics = metrics
+        self._name = name
+        self._labels = labels
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._metrics.observe(
+            self._name, time.perf_counter() - self._start, **self._labels
+        )
+        if exc_type is not None and not issubclass(exc_type, asyncio.CancelledError):
+            self._metrics.count("dobiss_errors_total", span=self._name)
+        return False
+
+
+class DobissMetrics:
+    """collects counters and histograms, and passes every measurement to the
+    registered sinks. Sinks are called as sink(kind, name, labels, value) with
+    kind "counter" or "histogram"."""
+
+    def __init__(self, buckets=DEF_METRICS_BUCKETS):
+        self._buckets = tuple(sorted(buckets))
+        self._counters = {}
+        self._histograms = {}
+        self._sinks = []
+
+    def add_sink(self, sink):
+        """Register a sink, called for every measurement"""
+        self._sinks.append(sink)
+
+    def remove_sink(self, sink):
+        """Remove previously registered sink."""
+        self._sinks.remove(sink)
+
+    def count(self, name, value=1, **labels):
+        """Increase a counter"""
+        key = (name, tuple(sorted(labels.items())))
+        self._counters[key] = self._counters.get(key, 0) + value
+        for sink in self._sinks:
+            sink("counter", name, labels, value)
+
+    def observe(self, name, value, **labels):
+        """Add a value to a histogram"""
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            # count per bucket, followed by the total count and the sum
+            histogram = self._histograms[key] = [0] * (len(self._buckets) + 2)
+        for i, bound in enumerate(self._buckets):
+            if value <= bound:
+                histogram[i] += 1
+                break
+        histogram[-2] += 1
+        histogram[-1] += value
+        for sink in self._sinks:
+            sink("histogram", name, labels, value)
+
+    def span(self, name, **labels):
+        """Return a context manager measuring its duration into histogram name"""
+        return DobissSpan(self, name, labels)
+
+    def get_counter(self, name, **labels):
+        """Return the value of a counter"""
+        return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def get_histogram(self, name, **labels):
+        """Return the count and sum of a histogram"""
+        histogram = self._histograms.get((name, tuple(sorted(labels.items()))))
+        if histogram is None:
+            return 0, 0.0
+        return histogram[-2], histogram[-1]
+
+    def reset(self):
+        """Forget all measurements"""
+        self._counters.clear()
+        self._histograms.clear()
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        labels = tuple(labels) + tuple(extra)
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+    def prometheus(self):
+        """Return all measurements in the prometheus text format"""
+        lines = []
+        typed = set()
+        for (name, labels), value in sorted(self._counters.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{self._format_labels(labels)} {value}")
+        for (name, labels), histogram in sorted(self._histograms.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, count in zip(self._buckets, histogram):
+                cumulative += count
+                le = self._format_labels(labels, (("le", bound),))
+                lines.append(f"{name}_bucket{le} {cumulative}")
+            le = self._format_labels(labels, (("le", "+Inf"),))
+            lines.append(f"{name}_bucket{le} {histogram[-2]}")
+            lines.append(f"{name}_count{self._format_labels(labels)} {histogram[-2]}")
+            lines.append(f"{name}_sum{self._format_labels(labels)} {histogram[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+class DobissHistory:
+    """a fixed size ring buffer of (monotonic timestamp, value) samples of an entity.
+    Samples are stored in 2 arrays of doubles, None values are stored as nan.
+    Queries take since and until as time.monotonic() timestamps, None for no limit."""
+
+    __slots__ = ("_times", "_values", "_size", "_start", "_count")
+
+    def __init__(self, size=DEF_HISTORY_SIZE):
+        if size < 1:
+            raise ValueError("History size must be at least 1")
+        self._size = size
+        self._times = array("d", bytes(8 * size))
+        self._values = array("d", bytes(8 * size))
+        # index of the oldest sample, and the number of samples
+        self._start = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def size(self):
+        """The maximum number of samples kept"""
+        return self._size
+
+    @property
+    def latest(self):
+        """The most recent (timestamp, value) sample, or None"""
+        if not self._count:
+            return None
+        return self._sample(self._count - 1)
+
+    def append(self, value, timestamp=None):
+        """Add a sample, overwriting the oldest sample when the buffer is full"""
+        if timestamp is None:
+            timestamp = time.monotonic()
+        if self._count < self._size:
+            index = (self._start + self._count) % self._size
+            self._count += 1
+        else:
+            index = self._start
+            self._start = (self._start + 1) % self._size
+        self._times[index] = timestamp
+        self._values[index] = math.nan if value is None else value
+
+    def clear(self):
+        self._start = 0
+        self._count = 0
+
+    def _sample(self, i):
+        index = (self._start + i) % self._size
+        value = self._values[index]
+        return self._times[index], None if math.isnan(value) else value
+
+    def _bisect(self, timestamp):
+        """the position of the first sample at or after timestamp"""
+        low, high = 0, self._count
+        times, start, size = self._times, self._start, self._size
+        while low < high:
+            middle = (low + high) // 2
+            if times[(start + middle) % size] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _range(self, since, until):
+        first = 0 if since is None else self._bisect(since)
+        last = self._count if until is None else self._bisect(until)
+        return first, last
+
+    def samples(self, since=None, until=None):
+        """Return the (timestamp, value) samples from since up to until"""
+        first, last = self._range(since, until)
+        return [self._sample(i) for i in range(first, last)]
+
+    def values(self, since=None, until=None):
+        """Return the values from since up to until, without the None values"""
+        first, last = self._range(since, until)
+        values = self._values
+        start, size = self._start, self._size
+        result = []
+        for i in range(first, last):
+            value = values[(start + i) % size]
+            if not math.isnan(value):
+                result.append(value)
+        return result
+
+    def min(self, since=None, until=None):
+        values = self.values(since, until)
+        return min(values) if values else None
+
+    def max(self, since=None, until=None):
+        values = self.values(since, until)
+        return max(values) if values else None
+
+    def mean(self, since=None, until=None):
+        values = self.values(since, until)
+        return math.fsum(values) / len(values) if values else None
+
+    def downsample(self, interval, since=None, until=None, aggregate="mean"):
+        """Return one (timestamp, value) sample per interval seconds, with the
+        timestamp at the start of the interval and the value the mean, min, max
+        or last of the values in that interval. Empty intervals are left out."""
+        if interval <= 0:
+            raise ValueError("Downsample interval must be positive")
+        functions = {
+            "mean": lambda values: math.fsum(values) / len(values),
+            "min": min,
+            "max": max,
+            "last": lambda values: values[-1],
+        }
+        if aggregate not in functions:
+            raise ValueError(f"Unknown aggregate {aggregate}")
+        function = functions[aggregate]
+        first, last = self._range(since, until)
+        if first == last:
+            return []
+        origin = self._sample(first)[0] if since is None else since
+        result = []
+        bucket = None
+        bucket_values = []
+        for i in range(first, last):
+            timestamp, value = self._sample(i)
+            current = int((timestamp - origin) // interval)
+            if current != bucket:
+                if bucket_values:
+                    result.append((origin + bucket * interval, function(bucket_values)))
+                bucket = current
+                bucket_values = []
+            if value is not None:
+                bucket_values.append(value)
+        if bucket_values:
+            result.append((origin + bucket * interval, function(bucket_values)))
+        return result
+
+
+class DobissRequestSlot:
+    """an async context manager holding one request slot of a DobissRequestLimiter"""
+
+    __slots__ = ("_limiter", "_start")
+
+    def __init__(self, limiter):
+        self._limiter = limiter
+        self._start = None
+
+    async def __aenter__(self):
+        await self._limiter.acquire()
+        self._start = time.monotonic()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._limiter.release(time.monotonic() - self._start, exc)
+        return False
+
+
+class DobissNoLimit:
+    """a request slot that never waits, used when requests are not limited"""
+
+    __slots__ = ()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+
+_NO_LIMIT = DobissNoLimit()
+
+
+class DobissRequestLimiter:
+    """limits the number of concurrent requests to the dobiss server. The limit grows
+    by one per limit successful requests faster than latency_target, and is
+    multiplied by backoff on slow or failed requests (additive increase,
+    multiplicative decrease). After failure_threshold consecutive failures the
+    circuit opens: requests fail immediately with DobissUnavailableError, until after
+    reset_timeout seconds a single probe request is let through to test recovery."""
+
+    def __init__(
+        self,
+        initial_limit=DEF_LIMIT_INITIAL,
+        min_limit=DEF_LIMIT_MIN,
+        max_limit=DEF_LIMIT_MAX,
+        latency_target=DEF_LIMIT_LATENCY_TARGET,
+        backoff=DEF_LIMIT_BACKOFF,
+        failure_threshold=DEF_BREAKER_THRESHOLD,
+        reset_timeout=DEF_BREAKER_RESET_TIMEOUT,
+    ):
+        if not 1 <= min_limit <= initial_limit <= max_limit:
+            raise ValueError("Limits must satisfy 1 <= min <= initial <= max")
+        if not 0 < backoff < 1:
+            raise ValueError("Backoff must be between 0 and 1")
+        self._limit = float(initial_limit)
+        self._min_limit = min_limit
+        self._max_limit = max_limit
+        self._latency_target = latency_target
+        self._backoff = backoff
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._in_flight = 0
+        self._waiters = deque()
+        self._failures = 0
+        self._state = DOBISS_CIRCUIT_CLOSED
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def limit(self):
+        """The current maximum number of concurrent requests"""
+        return max(self._min_limit, int(self._limit))
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+    @property
+    def state(self):
+        """The state of the circuit breaker"""
+        if (
+            self._state == DOBISS_CIRCUIT_OPEN
+            and time.monotonic() - self._opened_at >= self._reset_timeout
+        ):
+            return DOBISS_CIRCUIT_HALF_OPEN
+        return self._state
+
+    def request(self):
+        """Return an async context manager holding a request slot while the request runs"""
+        return DobissRequestSlot(self)
+
+    def _check_circuit(self):
+        state = self.state
+        if state == DOBISS_CIRCUIT_CLOSED:
+            return
+        if state == DOBISS_CIRCUIT_HALF_OPEN and not self._probing:
+            # let one request through, to see if the server recovered
+            self._state = DOBISS_CIRCUIT_HALF_OPEN
+            self._probing = True
+            return
+        raise DobissUnavailableError(
+            "Dobiss server is unavailable, not sending request"
+        )
+
+    async def acquire(self):
+        self._check_circuit()
+        if self._in_flight >= self.limit or self._waiters:
+            future = asyncio.get_running_loop().create_future()
+            self._waiters.append(future)
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # the slot was handed to us, pass it on
+                    self._in_flight -= 1
+                    self._wake()
+                elif future in self._waiters:
+                    self._waiters.remove(future)
+                raise
+        else:
+            self._in_flight += 1
+
+    def _wake(self):
+        while self._waiters and self._in_flight < self.limit:
+            future = self._waiters.popleft()
+            if not future.done():
+                self._in_flight += 1
+                future.set_result(None)
+
+    def _reject_waiters(self):
+        while self._waiters:
+            future = self._waiters.popleft()
+            if not future.done():
+                future.set_exception(
+                    DobissUnavailableError(
+                        "Dobiss server is unavailable, not sending request"
+                    )
+                )
+
+    @staticmethod
+    def _is_failure(exc):
+        if exc is None or isinstance(exc, asyncio.CancelledError):
+            return False
+        if isinstance(exc, aiohttp.ClientResponseError):
+            # the server answered, only server errors mean it is unhealthy
+            return exc.status >= 500
+        return isinstance(exc, (aiohttp.ClientError, asyncio.TimeoutError, OSError))
+
+    def release(self, latency, exc=None):
+        """Release a request slot, and adapt the limit to the latency and outcome"""
+        self._in_flight -= 1
+        probe = self._state == DOBISS_CIRCUIT_HALF_OPEN
+        if self._is_failure(exc):
+            self._failures += 1
+            self._limit = max(self._min_limit, self._limit * self._backoff)
+            if probe or self._failures >= self._failure_threshold:
+                if self._state != DOBISS_CIRCUIT_OPEN:
+                    logger.warning(
+                        f"Dobiss server unhealthy after {self._failures} failures, "
+                        f"pausing requests for {self._reset_timeout} seconds"
+                    )
+                self._state = DOBISS_CIRCUIT_OPEN
+                self._opened_at = time.monotonic()
+                self._probing = False
+                self._reject_waiters()
+                return
+        elif exc is None:
+            self._failures = 0
+            if probe:
+                logger.info("Dobiss server recovered, resuming requests")
+                self._state = DOBISS_CIRCUIT_CLOSED
+                self._probing = False
+            if latency > self._latency_target:
+                self._limit = max(self._min_limit, self._limit * self._backoff)
+            else:
+                self._limit = min(self._max_limit, self._limit + 1 / self._limit)
+        elif probe:
+            # the probe did not tell anything, let the next request probe
+            self._probing = False
+        self._wake()
+
+
 class DobissEntity:
     """a generic Dobiss Entity, can be a light, switch, sensor, etc..."""
 
+    __slots__ = (
+        "_json",
+        "_status",
+        "_attributes",
+        "_groupname",
+        "_name",
+        "_address",
+        "_channel",
+        "_dimmable",
+        "_icons_id",
+        "_type",
+        "_object_id",
+        "_value",
+        "_dobiss",
+        "_callbacks",
+        "_buddy",
+        "_debounce",
+        "_history",
+        "__weakref__",
+    )
+
     def __init__(self, dobiss, data, groupname):
         """Initialize a DobissLight"""
         self._json = data
-        self._attributes = dict()
-        self._attributes["dobiss_group"] = groupname
-        self._attributes.update(data)
+        # the last status dict pushed, when the status contains more than a value
+        self._status = None
+        # attributes are only built when requested
+        self._attributes = None
         self._groupname = groupname
         self._name = data["name"]
         self._address = int(data["address"])
@@ -96,8 +667,10 @@ class DobissEntity:
         self._object_id = "dobissid_{}_{}".format(self._address, self._channel)
         self._value = None
         self._dobiss = dobiss
-        self._callbacks = list()
+        self._callbacks = ()
         self._buddy = None
+        self._debounce = None
+        self._history = None
 
     def update_from_discovery(self, entity):
         self._json = entity.json
@@ -106,7 +679,7 @@ class DobissEntity:
         self._dimmable = entity.dimmable
         self._icons_id = entity.icons_id
         self._type = entity.type
-        self._attributes.update(entity.attributes)
+        self._attributes = None
 
     @property
     def buddy(self):
@@ -116,8 +689,22 @@ class DobissEntity:
     @property
     def attributes(self):
         """Return all attributes of this entity"""
+        if self._attributes is None:
+            attributes = {"dobiss_group": self._groupname}
+            attributes.update(self._json)
+            if self._status is not None:
+                attributes.update(self._status)
+            self._attributes = attributes
         return self._attributes
 
+    def get_attribute(self, key, default=None):
+        """Return a single attribute of this entity, without building all attributes"""
+        if self._status is not None and key in self._status:
+            return self._status[key]
+        if key == "dobiss_group":
+            return self._groupname
+        return self._json.get(key, default)
+
     def set_buddy(self, entity):
         self._buddy = entity
 
@@ -178,16 +765,59 @@ class DobissEntity:
 
     def register_callback(self, callback):
         """Register callback, called when changes state."""
-        self._callbacks.append(callback)
+        self._callbacks = self._callbacks + (callback,)
 
     def remove_callback(self, callback):
         """Remove previously registered callback."""
-        self._callbacks.remove(callback)
+        callbacks = list(self._callbacks)
+        callbacks.remove(callback)
+        self._callbacks = tuple(callbacks)
+
+    @property
+    def debounce(self):
+        """The minimum time in seconds between 2 calls of the callbacks when a
+        callback dispatcher is used, None to use the default of the dispatcher"""
+        return self._debounce
+
+    @debounce.setter
+    def debounce(self, value):
+        self._debounce = value
+
+    @property
+    def history(self):
+        """The DobissHistory of the values of this entity, None if disabled"""
+        return self._history
+
+    def enable_history(self, size=DEF_HISTORY_SIZE):
+        """Keep the last size values of this entity, with the time they were pushed"""
+        if self._history is None or self._history.size != size:
+            self._history = DobissHistory(size)
+        return self._history
+
+    def disable_history(self):
+        self._history = None
 
     async def publish_updates(self):
         """Schedule call all registered callbacks."""
+        dispatcher = self._dobiss.callback_dispatcher if self._dobiss else None
+        if dispatcher is not None:
+            dispatcher.publish(self)
+        else:
+            await self.run_callbacks()
+
+    async def run_callbacks(self):
+        """Call all registered callbacks, callbacks can be coroutine functions."""
+        metrics = self._dobiss.metrics if self._dobiss else None
         for callback in self._callbacks:
-            callback()
+            if metrics is not None:
+                with metrics.span("dobiss_callback_seconds"):
+                    result = callback()
+                    if inspect.isawaitable(result):
+                        await result
+            else:
+                result = callback()
+                if inspect.isawaitable(result):
+                    await result
 
     # '204':
     # {
@@ -202,23 +832,40 @@ class DobissEntity:
     async def push(self, status, force=False):
         """when an external status udate happened,
         and you want to update the internal value"""
-        attributes = self._attributes
+        status_changed = False
         if self.address == DOBISS_TEMPERATURE:
             try:
                 val = float(status["temp"])
             except ValueError:
                 val = None
-            attributes = self._attributes.copy()
-            attributes.update(status)
+            status_changed = self._status != status
         else:
             if type(status) == dict:
                 val = int(status["status"])
             else:
                 val = int(status)
-        if force or self._value != val or self._attributes != attributes:
+        if force or self._value != val or status_changed:
+            if self._history is not None and (force or self._value != val):
+                self._history.append(val)
+            old_value = self._value
+            old_status = self._status
             self._value = val
-            self._attributes = attributes
-            logger.debug(f"Updated {self._name} to {val} {self._attributes}")
+            if status_changed:
+                self._status = status
+                self._attributes = None
+            logger.debug(f"Updated {self._name} to {val} {status}")
+            if self._dobiss is not None and self._dobiss.has_subscribers:
+                changed = {}
+                if status_changed:
+                    old_status = old_status or {}
+                    changed = {
+                        key: value
+                        for key, value in status.items()
+                        if key not in old_status or old_status[key] != value
+                    }
+                await self._dobiss.publish_event(
+                    DobissEvent(self, old_value, val, changed)
+                )
             await self.publish_updates()
 
     async def update_from_global(self, status, force=False):
@@ -227,36 +874,126 @@ class DobissEntity:
          and parse the update data here to fetch what is needed"""
         try:
             if str(self.address) in status:
-                line = status[str(self.address)]
-                if type(line) == list and len(status[str(self.address)]) > self.channel:
-                    await self.push(status[str(self.address)][self.channel], force)
-                elif (
-                    type(line) == dict
-                    and str(self.channel) in status[str(self.address)]
-                ):
-                    await self.push(status[str(self.address)][str(self.channel)], force)
-                # else:
-                #    logger.debug(f"{self.name} not found in status update")
-                # logger.debug("Updated {} = {}: groupname {}; addr {};
-                #  channel {}; dimmable {}".format(self.name, self._value,
-                #  self.groupname, self.address, self.channel, self.dimmable))
+                await self.update_from_line(status[str(self.address)], force)
             # else:
             #    logger.debug("{} not found in update".format(self.name))
         except Exception as error:
             logger.exception(f"Error trying to update {self.name}: {repr(error)}")
 
+    async def update_from_line(self, line, force=False):
+        """update the internal value from the status line of this entity's module,
+        i.e. the part of a status update that belongs to this entity's address"""
+        try:
+            if type(line) == list and len(line) > self.channel:
+                await self.push(line[self.channel], force)
+            elif type(line) == dict and str(self.channel) in line:
+                await self.push(line[str(self.channel)], force)
+            # else:
+            #    logger.debug(f"{self.name} not found in status update")
+            # logger.debug("Updated {} = {}: groupname {}; addr {};
+            #  channel {}; dimmable {}".format(self.name, self._value,
+            #  self.groupname, self.address, self.channel, self.dimmable))
+        except Exception as error:
+            logger.exception(f"Error trying to update {self.name}: {repr(error)}")
+
     async def update(self):
         """Fetch new state data for this entity.
         This is the only method that should fetch new data for Home Assistant.
         """
-        response = await self._dobiss.status(self._address, self._channel)
-        data = await response.json()
-        await self.push(data["status"])
+        status = await self._dobiss.refresh_status(self._address, self._channel)
+        await self.push(status)
 
 
 class DobissOutput(DobissEntity):
     """a generic Dobiss Output, can be a light, switch, etc..."""
 
+    __slots__ = ("_expected", "_confirmed", "_rollback_timer")
+
+    def __init__(self, dobiss, data, groupname):
+        super().__init__(dobiss, data, groupname)
+        # the value expected after an optimistic update, and the last value
+        # confirmed by the dobiss server, to roll back to
+        self._expected = None
+        self._confirmed = None
+        self._rollback_timer = None
+
+    @property
+    def pending(self):
+        """True while an optimistic update waits for confirmation by the dobiss server"""
+        return self._expected is not None
+
+    async def _set_value(self, value):
+        old_value = self._value
+        if old_value == value:
+            return
+        # the history only keeps values reported by the dobiss server, see push
+        self._value = value
+        if self._dobiss.has_subscribers:
+            await self._dobiss.publish_event(DobissEvent(self, old_value, value, {}))
+        await self.publish_updates()
+
+    def _clear_optimistic(self):
+        if self._rollback_timer is not None:
+            self._rollback_timer.cancel()
+            self._rollback_timer = None
+        self._expected = None
+        self._confirmed = None
+
+    async def _rollback(self):
+        if self._expected is None:
+            return
+        value = self._confirmed
+        self._clear_optimistic()
+        logger.debug(f"Optimistic update of {self._name} not confirmed, rolled back")
+        await self._set_value(value)
+
+    async def _optimistic_action(self, expected, action, *args, **kwargs):
+        """send an action, and with optimistic updates enabled show the expected value
+        until the dobiss server confirms it, or roll back after the timeout"""
+        timeout = self._dobiss.get_optimistic_timeout(self)
+        if timeout is None:
+            await self._dobiss.action(
+                self._address, self._channel, action, *args, **kwargs
+            )
+            return
+        if self._expected is None:
+            self._confirmed = self._value
+        elif self._rollback_timer is not None:
+            self._rollback_timer.cancel()
+        self._expected = expected
+        self._rollback_timer = asyncio.get_running_loop().call_later(
+            timeout, lambda: asyncio.ensure_future(self._rollback())
+        )
+        await self._set_value(expected)
+        try:
+            await self._dobiss.action(
+                self._address, self._channel, action, *args, **kwargs
+            )
+        except Exception:
+            await self._rollback()
+            raise
+
+    async def push(self, status, force=False):
+        if self._expected is not None:
+            val = int(status["status"]) if type(status) == dict else int(status)
+            if self._dimmable:
+                # a status update of another channel of the module re-sends the
+                # old brightness, only the requested brightness confirms
+                confirmed = val == self._expected
+            else:
+                confirmed = (val > 0) == (self._expected > 0)
+            if not confirmed:
+                # not the expected state (yet), keep showing it until the timeout
+                if self._history is not None and val != self._confirmed:
+                    self._history.append(val)
+                self._confirmed = val
+                return
+            self._clear_optimistic()
+            if self._history is not None and val == self._value and not force:
+                # the value is already shown, so the base class will not record it
+                self._history.append(val)
+        await super().push(status, force)
+
     async def toggle(self):
         if self.is_on:
             await self.turn_off()
@@ -276,43 +1013,66 @@ class DobissOutput(DobissEntity):
             value = 9
         else:
             value = 1
-        await self._dobiss.action(
-            self._address, self._channel, 1, value, delayon=delayon, delayoff=delayoff
-        )
+        if delayon is not None:
+            # the state does not change now, nothing to show optimistically
+            await self._dobiss.action(
+                self._address,
+                self._channel,
+                1,
+                value,
+                delayon=delayon,
+                delayoff=delayoff,
+            )
+            return
+        await self._optimistic_action(value, 1, value, delayoff=delayoff)
 
     async def turn_off(self):
         """Instruct the entity to turn off."""
-        await self._dobiss.action(self._address, self._channel, 0)
+        await self._optimistic_action(0, 0)
 
 
 class DobissLight(DobissOutput):
     """a dobiss light object, can be dimmable or not"""
 
+    __slots__ = ()
+
 
 class DobissAnalogOutput(DobissOutput):
     """a dobiss light object, can be dimmable or not"""
 
+    __slots__ = ()
+
 
 class DobissSwitch(DobissOutput):
     """a dobiss switch, can be up/down switch, door switch, etc..."""
 
+    __slots__ = ()
+
 
 class DobissScenario(DobissSwitch):
     """a dobiss scenario"""
 
+    __slots__ = ()
+
 
 class DobissAutomation(DobissSwitch):
     """a dobiss automation"""
 
+    __slots__ = ()
+
 
 class DobissFlag(DobissSwitch):
     """a dobiss flag"""
 
+    __slots__ = ()
+
 
 class DobissSensor(DobissEntity):
     """a dobiss sensor, can be binary or not,
     lightswitch, temperature sensor, etc"""
 
+    __slots__ = ("_unit",)
+
     def __init__(self, dobiss, data, groupname):
         super().__init__(dobiss, data, groupname)
         self._unit = None
@@ -328,6 +1088,8 @@ class DobissSensor(DobissEntity):
 class DobissTempSensor(DobissSensor):
     """a dobiss Temperature Sensor"""
 
+    __slots__ = ("_default_time",)
+
     def __init__(self, dobiss, data, groupname):
         super().__init__(dobiss, data, groupname)
         self._unit = "C"
@@ -335,14 +1097,14 @@ class DobissTempSensor(DobissSensor):
 
     @property
     def asked(self):
-        asked = self.attributes.get("asked")
+        asked = self.get_attribute("asked")
         if asked is not None:
             return float(asked)
         return None
 
     @property
     def status(self):
-        return self.attributes.get("status")
+        return self.get_attribute("status")
 
     @property
     def time(self):
@@ -350,13 +1112,13 @@ class DobissTempSensor(DobissSensor):
         #  if time == -15 --> forever;
         #  if time == -30 --> calendar;
         #  else minutes
-        return self.attributes.get("time")
+        return self.get_attribute("time")
 
     @property
     def calendar(self):
         """Return the current preset mode, e.g., home, away, temp."""
-        if "calendar" in self.attributes:
-            calendar = self.attributes["calendar"]
+        calendar = self.get_attribute("calendar")
+        if calendar is not None:
             if self._dobiss.temp_calendars is not None:
                 for cal in self._dobiss.temp_calendars:
                     if calendar == cal["id"]:
@@ -449,15 +1211,814 @@ class DobissTempSensor(DobissSensor):
 class DobissBinarySensor(DobissSensor):
     """a dobiss Binary Sensor"""
 
+    __slots__ = ()
+
 
 class DobissLightSensor(DobissSensor):
     """a dobiss Light Sensor"""
 
+    __slots__ = ()
+
     def __init__(self, dobiss, data, groupname):
         super().__init__(dobiss, data, groupname)
         self._unit = "%"
 
 
+# entity class for discovered subjects by (type, icons_id, dimmable)
+# None matches any value, dimmable is True when the subject has a dimmable setting
+DOBISS_DEVICE_CLASSES = {
+    # lights
+    (None, DOBISS_LIGHT, None): DobissLight,
+    (None, DOBISS_TABLELIGHT, None): DobissLight,
+    (None, DOBISS_RED, None): DobissLight,
+    (None, DOBISS_GREEN, None): DobissLight,
+    (None, DOBISS_BLUE, None): DobissLight,
+    (None, DOBISS_WHITE, None): DobissLight,
+    # other items connected to a 0-10V output
+    (DOBISS_TYPE_ANALOG, None, None): DobissAnalogOutput,
+    # other items connected to a relais
+    (DOBISS_TYPE_RELAIS, None, None): DobissSwitch,
+    (DOBISS_TYPE_INPUT, None, None): DobissBinarySensor,
+    (DOBISS_TYPE_FLAG, None, None): DobissFlag,
+    (DOBISS_TYPE_SCENARIO, None, None): DobissScenario,
+    (DOBISS_TYPE_AUTOMATION, None, None): DobissAutomation,
+    # logical conditions
+    # (DOBISS_TYPE_CONDITION, None, None): DobissSensor,
+    (DOBISS_TYPE_TEMPERATURE, None, None): DobissTempSensor,
+    # lightcell or input contact
+    (DOBISS_TYPE_NXT, DOBISS_LIGHTSENSOR, None): DobissLightSensor,
+    (DOBISS_TYPE_NXT, DOBISS_INPUTSTATUS, None): DobissBinarySensor,
+    # other things connected to dobiss NXT directly?? In demo there are screens etc
+    **{
+        (DOBISS_TYPE_NXT, icons_id, dimmable): (
+            DobissAnalogOutput if dimmable else DobissSwitch
+        )
+        for icons_id in (
+            DOBISS_UP,
+            DOBISS_DOWN,
+            DOBISS_GARAGE,
+            DOBISS_DOOR,
+            DOBISS_GATE,
+            DOBISS_VENTILATION,
+            DOBISS_HEATING,
+        )
+        for dimmable in (True, False)
+    },
+}
+
+
+class DobissRegistry:
+    """keeps the discovered devices, indexed by object id, address and channel,
+    type and group name, so lookups don't need to walk all devices"""
+
+    def __init__(self):
+        self._devices = []
+        self._by_id = {}
+        self._by_address = {}
+        self._by_type = {}
+        self._by_group = {}
+
+    def __len__(self):
+        return len(self._devices)
+
+    def __iter__(self):
+        return iter(self._devices)
+
+    def __contains__(self, dev_id):
+        return dev_id in self._by_id
+
+    @property
+    def devices(self):
+        """Return the list of all devices, in order of discovery"""
+        return self._devices
+
+    @property
+    def groups(self):
+        """Return the names of all groups that contain devices"""
+        return list(self._by_group)
+
+    def add(self, device):
+        """Add a device to the registry, replacing a device with the same object id"""
+        if device.object_id in self._by_id:
+            self.remove(device.object_id)
+        self._devices.append(device)
+        self._by_id[device.object_id] = device
+        self._by_address.setdefault(str(device.address), {})[device.channel] = device
+        self._by_type.setdefault(type(device), {})[device.object_id] = device
+        self._by_group.setdefault(device.groupname, {})[device.object_id] = device
+
+    def remove(self, dev_id):
+        """Remove a device from the registry, returns the removed device"""
+        device = self._by_id.pop(dev_id, None)
+        if device is None:
+            return None
+        self._devices.remove(device)
+        self._discard(self._by_address, str(device.address), device.channel)
+        self._discard(self._by_type, type(device), dev_id)
+        self._discard(self._by_group, device.groupname, dev_id)
+        return device
+
+    def regroup(self, device, old_groupname):
+        """Move a device to its new group after its groupname changed"""
+        if device.groupname == old_groupname:
+            return
+        self._discard(self._by_group, old_groupname, device.object_id)
+        self._by_group.setdefault(device.groupname, {})[device.object_id] = device
+
+    @staticmethod
+    def _discard(index, key, subkey):
+        entries = index.get(key)
+        if entries is not None:
+            entries.pop(subkey, None)
+            if not entries:
+                del index[key]
+
+    def get(self, dev_id):
+        """Return the device with the given object id, or None"""
+        return self._by_id.get(dev_id)
+
+    def get_by_address(self, address, channel):
+        """Return the device on the given address and channel, or None"""
+        return self._by_address.get(str(address), {}).get(int(channel))
+
+    def get_channels(self, address):
+        """Return a dict channel -> device of all devices on the given address"""
+        return self._by_address.get(str(address))
+
+    def get_by_type(self, dev_type):
+        """Return all devices that are an instance of dev_type"""
+        device_list = []
+        for cls, devices in self._by_type.items():
+            if issubclass(cls, dev_type):
+                device_list.extend(devices.values())
+        return device_list
+
+    def get_by_group(self, groupname):
+        """Return all devices in the given group"""
+        return list(self._by_group.get(groupname, {}).values())
+
+
+class DobissEvent:
+    """a state change of an entity: the old and new value, and the status
+    attributes that changed, with their new value"""
+
+    __slots__ = ("entity", "old_value", "new_value", "changed", "timestamp")
+
+    def __init__(self, entity, old_value, new_value, changed, timestamp=None):
+        self.entity = entity
+        self.old_value = old_value
+        self.new_value = new_value
+        self.changed = changed
+        self.timestamp = time.monotonic() if timestamp is None else timestamp
+
+    def merge(self, event):
+        """Return an event combining this event with the later event of the same entity"""
+        changed = dict(self.changed)
+        changed.update(event.changed)
+        return DobissEvent(
+            self.entity, self.old_value, event.new_value, changed, event.timestamp
+        )
+
+    def __repr__(self):
+        return (
+            f"DobissEvent({self.entity.object_id}: {self.old_value} -> "
+            f"{self.new_value}, {self.changed})"
+        )
+
+
+class DobissApplyResult:
+    """the outcome of apply_state for one entity: the requested target, and whether
+    a command was sent, was not needed, failed (with the error) or the entity was not found
+    """
+
+    __slots__ = ("entity", "target", "result", "error")
+
+    def __init__(self, entity, target, result, error=None):
+        self.entity = entity
+        self.target = target
+        self.result = result
+        self.error = error
+
+    def __repr__(self):
+        name = self.entity.object_id if self.entity is not None else None
+        return f"DobissApplyResult({name}: {self.target} {self.result})"
+
+
+class DobissEventSubscription:
+    """an async iterator over the state change events of a DobissAPI, with a queue of
+    at most max_queue events. When the queue is full, overflow decides what happens:
+    DOBISS_OVERFLOW_DROP_OLDEST drops the oldest event, DOBISS_OVERFLOW_COALESCE merges
+    the events of the same entity (and drops the oldest entity when still full), and
+    DOBISS_OVERFLOW_BLOCK makes the publisher wait until there is room again.
+
+        async with dobiss.events() as events:
+            async for event in events:
+                ...
+    """
+
+    def __init__(
+        self,
+        dobiss,
+        max_queue=DEF_EVENT_QUEUE_SIZE,
+        overflow=DOBISS_OVERFLOW_DROP_OLDEST,
+    ):
+        if overflow not in (
+            DOBISS_OVERFLOW_DROP_OLDEST,
+            DOBISS_OVERFLOW_COALESCE,
+            DOBISS_OVERFLOW_BLOCK,
+        ):
+            raise ValueError(f"Unknown overflow policy {overflow}")
+        if max_queue < 1:
+            raise ValueError("Event queue size must be at least 1")
+        self._dobiss = dobiss
+        self._max_queue = max_queue
+        self._overflow = overflow
+        # coalesced events are kept per entity, in order of their first event
+        self._queue = {} if overflow == DOBISS_OVERFLOW_COALESCE else deque()
+        self._readable = asyncio.Event()
+        self._writable = asyncio.Event()
+        self._writable.set()
+        self._closed = False
+        self._dropped = 0
+
+    @property
+    def overflow(self):
+        return self._overflow
+
+    @property
+    def dropped(self):
+        """The number of events dropped because the queue was full"""
+        return self._dropped
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def __len__(self):
+        return len(self._queue)
+
+    async def put(self, event):
+        """Queue an event, called by the api for every state change"""
+        if self._closed:
+            return
+        if self._overflow == DOBISS_OVERFLOW_COALESCE:
+            queued = self._queue.get(event.entity)
+            if queued is not None:
+                self._queue[event.entity] = queued.merge(event)
+                return
+            if len(self._queue) >= self._max_queue:
+                del self._queue[next(iter(self._queue))]
+                self._dropped += 1
+            self._queue[event.entity] = event
+        else:
+            while len(self._queue) >= self._max_queue:
+                if self._overflow == DOBISS_OVERFLOW_DROP_OLDEST:
+                    self._queue.popleft()
+                    self._dropped += 1
+                    break
+                self._writable.clear()
+                await self._writable.wait()
+                if self._closed:
+                    return
+            self._queue.append(event)
+        self._readable.set()
+
+    def _take(self, max_events):
+        if self._overflow == DOBISS_OVERFLOW_COALESCE:
+            entities = list(self._queue)[:max_events]
+            events = [self._queue.pop(entity) for entity in entities]
+        else:
+            count = min(max_events, len(self._queue))
+            events = [self._queue.popleft() for _ in range(count)]
+        if not self._queue:
+            self._readable.clear()
+        self._writable.set()
+        return events
+
+    async def get_batch(self, max_events=None):
+        """Wait for events, and return all queued events, at most max_events.
+        Returns an empty list when the subscription is closed."""
+        while not self._queue:
+            if self._closed:
+                return []
+            await self._readable.wait()
+        return self._take(max_events or len(self._queue))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        events = await self.get_batch(1)
+        if not events:
+            raise StopAsyncIteration
+        return events[0]
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        """Stop receiving events, waiting consumers and publishers are released"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.clear()
+        self._readable.set()
+        self._writable.set()
+        self._dobiss.remove_subscription(self)
+
+
+class DobissCallbackDispatcher:
+    """calls the callbacks of updated entities from a separate task, so slow callbacks
+    don't block the websocket connection. An entity is queued at most once, and with
+    a debounce window its callbacks are called at most once per window."""
+
+    def __init__(self, max_queue=DEF_CALLBACK_QUEUE_SIZE, debounce=None):
+        self._queue = asyncio.Queue(maxsize=max_queue)
+        self._debounce = debounce
+        self._queued = set()
+        self._timers = {}
+        self._worker = None
+
+    @property
+    def debounce(self):
+        """The default debounce window in seconds, None to call the callbacks for every update"""
+        return self._debounce
+
+    @debounce.setter
+    def debounce(self, value):
+        self._debounce = value
+
+    @property
+    def pending(self):
+        """The number of entities waiting for their callbacks to be called"""
+        return len(self._queued) + len(self._timers)
+
+    def publish(self, entity):
+        """Schedule a call of the callbacks of entity"""
+        if entity in self._queued or entity in self._timers:
+            # the callbacks will see this update as well
+            return
+        debounce = entity.debounce if entity.debounce is not None else self._debounce
+        if debounce:
+            self._timers[entity] = asyncio.get_running_loop().call_later(
+                debounce, self._debounced, entity
+            )
+        else:
+            self._enqueue(entity)
+
+    def _debounced(self, entity):
+        del self._timers[entity]
+        self._enqueue(entity)
+
+    def _enqueue(self, entity):
+        try:
+            self._queue.put_nowait(entity)
+        except asyncio.QueueFull:
+            logger.warning(f"Callback queue full, dropping update of {entity.name}")
+            return
+        self._queued.add(entity)
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while True:
+            entity = await self._queue.get()
+            self._queued.discard(entity)
+            try:
+                await entity.run_callbacks()
+            except Exception as error:
+                logger.exception(f"Callback of {entity.name} failed: {repr(error)}")
+            finally:
+                self._queue.task_done()
+
+    async def join(self):
+        """Wait until all queued callbacks are called, debounced updates not included"""
+        await self._queue.join()
+
+    async def close(self):
+        """Stop calling callbacks, pending updates are dropped"""
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        if self._worker is not None and not self._worker.done():
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+        self._worker = None
+
+
+# actions that don't replace an earlier queued action of the same kind
+DOBISS_UNMERGEABLE_ACTIONS = (2,)
+
+
+class DobissActionQueue:
+    """collects actions during a short flush window, and limits the number of requests
+    in flight. An action replaces the action queued right before it for the same
+    address and channel when it is the same action, except for toggles. The other
+    actions are sent in order."""
+
+    def __init__(
+        self,
+        dobiss,
+        flush_window=DEF_ACTION_FLUSH_WINDOW,
+        max_in_flight=DEF_ACTION_MAX_IN_FLIGHT,
+    ):
+        if max_in_flight < 1:
+            raise ValueError("At least 1 request in flight is required")
+        self._dobiss = dobiss
+        self._flush_window = flush_window
+        self._max_in_flight = max_in_flight
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._pending = {}
+        self._in_flight = {}
+        self._flush_handle = None
+
+    @property
+    def flush_window(self):
+        """The time in seconds actions are collected before they are sent"""
+        return self._flush_window
+
+    @property
+    def max_in_flight(self):
+        """The maximum number of requests sent concurrently"""
+        return self._max_in_flight
+
+    @property
+    def pending(self):
+        """The number of actions waiting for the next flush"""
+        return sum(len(entries) for entries in self._pending.values())
+
+    def submit(self, data):
+        """Queue an action request, returns a future with the result of the request.
+        When the next action for the same address and channel in the same flush window
+        replaces this one, the future gets the result of the replacing request."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        key = (data["address"], data["channel"])
+        entries = self._pending.setdefault(key, [])
+        if (
+            entries
+            and entries[-1][0]["action"] == data["action"]
+            and data["action"] not in DOBISS_UNMERGEABLE_ACTIONS
+        ):
+            logger.debug(f"Replacing queued {entries[-1][0]} by {data}")
+            entries[-1] = (data, entries[-1][1] + [future])
+        else:
+            entries.append((data, [future]))
+        if self._flush_handle is None:
+            self._flush_handle = loop.call_later(self._flush_window, self._flush)
+        return future
+
+    def _flush(self):
+        self._flush_handle = None
+        pending, self._pending = self._pending, {}
+        for key, entries in pending.items():
+            # keep the order of requests for the same address and channel
+            previous = self._in_flight.get(key)
+            task = asyncio.ensure_future(self._send(entries, previous))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda t, key=key: self._sent(key, t))
+
+    def _sent(self, key, task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+
+    async def _send(self, entries, previous=None):
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            for data, futures in entries:
+                try:
+                    async with self._semaphore:
+                        result = await self._dobiss.request_json(data)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as error:
+                    for future in futures:
+                        if not future.done():
+                            future.set_exception(error)
+                else:
+                    for future in futures:
+                        if not future.done():
+                            future.set_result(result)
+        except asyncio.CancelledError:
+            for _, futures in entries:
+                for future in futures:
+                    future.cancel()
+            raise
+
+    async def flush(self):
+        """Send all queued actions now, and wait until all requests are done"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        self._flush()
+        if self._in_flight:
+            await asyncio.wait(list(self._in_flight.values()))
+
+
+class DobissPoller:
+    """polls the status while the websocket connection is down.
+    The complete status is polled every min_interval seconds after a change,
+    backing off to max_interval seconds while nothing changes. Modules that
+    changed in the last hot_window seconds are polled every min_interval seconds."""
+
+    def __init__(
+        self,
+        dobiss,
+        min_interval=DEF_POLL_MIN_INTERVAL,
+        max_interval=DEF_POLL_MAX_INTERVAL,
+        hot_window=DEF_POLL_HOT_WINDOW,
+    ):
+        if min_interval <= 0 or max_interval < min_interval:
+            raise ValueError("Invalid polling intervals")
+        self._dobiss = dobiss
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._hot_window = hot_window
+        self._interval = min_interval
+        self._last_change = {}
+        self._task = None
+        self._poll_count = 0
+
+    @property
+    def running(self):
+        """True while polling"""
+        return self._task is not None and not self._task.done()
+
+    @property
+    def interval(self):
+        """The current interval in seconds between 2 polls of the complete status"""
+        return self._interval
+
+    @property
+    def poll_count(self):
+        """The number of status requests sent"""
+        return self._poll_count
+
+    @property
+    def hot_addresses(self):
+        """The addresses of the modules that changed recently"""
+        now = asyncio.get_running_loop().time()
+        return [
+            address
+            for address, changed in self._last_change.items()
+            if now - changed < self._hot_window
+        ]
+
+    def start(self):
+        """Start polling, if not polling already"""
+        if not self.running:
+            logger.debug("Start polling the dobiss status")
+            self._interval = self._min_interval
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        """Stop polling"""
+        if self.running:
+            logger.debug("Stop polling the dobiss status")
+            self._task.cancel()
+        self._task = None
+
+    def _changed(self, delta, known):
+        """remember the modules that changed, returns True if any module changed"""
+        if not isinstance(delta, dict):
+            return False
+        now = asyncio.get_running_loop().time()
+        changed = False
+        for address, line in delta.items():
+            # the first status of a module is no change
+            if line and address in known:
+                self._last_change[address] = now
+                changed = True
+        # forget the modules that are no longer hot
+        for address in [
+            address
+            for address, changed in self._last_change.items()
+            if now - changed >= self._hot_window
+        ]:
+            del self._last_change[address]
+        return changed
+
+    async def _poll_all(self):
+        self._poll_count += 1
+        known = set(self._dobiss._status_snapshot)
+        delta = await self._dobiss.update_all()
+        if self._changed(delta, known):
+            self._interval = self._min_interval
+        else:
+            self._interval = min(self._max_interval, self._interval * 2)
+
+    async def _poll_address(self, address):
+        self._poll_count += 1
+        data = await self._dobiss.status_json(int(address))
+        status = {str(address): self._dobiss.get_module_line(address, data["status"])}
+        known = set(self._dobiss._status_snapshot)
+        delta = self._dobiss._get_status_delta(status)
+        await self._dobiss.update_from_status(delta)
+        self._changed(delta, known)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_poll_all = loop.time()
+        while True:
+            try:
+                if loop.time() >= next_poll_all:
+                    await self._poll_all()
+                    next_poll_all = loop.time() + self._interval
+                else:
+                    for address in self.hot_addresses:
+                        await self._poll_address(address)
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                logger.exception(f"Polling dobiss status failed: {repr(error)}")
+                self._interval = min(self._max_interval, self._interval * 2)
+                next_poll_all = loop.time() + self._interval
+            delay = next_poll_all - loop.time()
+            if self._last_change:
+                delay = min(delay, self._min_interval)
+            await asyncio.sleep(max(delay, 0))
+
+
+class DobissRefreshCoalescer:
+    """combines status requests for single channels: requests for the same address
+    and channel share one request, and requests for several channels of one module
+    within the window are sent as one status request for the module"""
+
+    def __init__(self, dobiss, window=DEF_REFRESH_WINDOW):
+        self._dobiss = dobiss
+        self._window = window
+        self._pending = {}
+        self._in_flight = {}
+        self._flush_handle = None
+        self._request_count = 0
+
+    @property
+    def window(self):
+        """The time in seconds requests are collected before they are sent"""
+        return self._window
+
+    @window.setter
+    def window(self, value):
+        self._window = value
+
+    @property
+    def request_count(self):
+        """The number of status requests sent"""
+        return self._request_count
+
+    def refresh(self, address, channel):
+        """Request the status of a channel, returns a future with the status"""
+        key = (address, channel)
+        future = self._in_flight.get(key)
+        if future is not None:
+            # a request for this channel is on its way
+            return future
+        channels = self._pending.setdefault(address, {})
+        future = channels.get(channel)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = channels[channel] = loop.create_future()
+            if self._flush_handle is None:
+                self._flush_handle = loop.call_later(self._window, self._flush)
+        return future
+
+    def _flush(self):
+        self._flush_handle = None
+        pending, self._pending = self._pending, {}
+        for address, channels in pending.items():
+            for channel, future in channels.items():
+                key = (address, channel)
+                self._in_flight[key] = future
+                future.add_done_callback(lambda f, key=key: self._done(key, f))
+            asyncio.ensure_future(self._fetch(address, channels))
+
+    def _done(self, key, future):
+        if self._in_flight.get(key) is future:
+            del self._in_flight[key]
+
+    async def _fetch(self, address, channels):
+        try:
+            self._request_count += 1
+            if len(channels) == 1:
+                ((channel, future),) = channels.items()
+                data = await self._dobiss.status_json(address, channel)
+                if not future.done():
+                    future.set_result(data["status"])
+                return
+            data = await self._dobiss.status_json(address)
+            line = self._dobiss.get_module_line(address, data["status"])
+            for channel, future in channels.items():
+                if future.done():
+                    continue
+                if type(line) == list and channel < len(line):
+                    future.set_result(line[channel])
+                elif type(line) == dict and str(channel) in line:
+                    future.set_result(line[str(channel)])
+                else:
+                    future.set_exception(
+                        KeyError(f"No status for address {address} channel {channel}")
+                    )
+        except Exception as error:
+            for future in channels.values():
+                if not future.done():
+                    future.set_exception(error)
+
+
+class DobissTokenManager:
+    """creates the JWT tokens for the dobiss server, and keeps the authorization
+    header ready. A new token is created refresh_margin seconds before the current
+    one expires, from a timer when an event loop is running."""
+
+    def __init__(
+        self,
+        secret,
+        lifetime=DEF_TOKEN_LIFETIME,
+        refresh_margin=DEF_TOKEN_REFRESH_MARGIN,
+    ):
+        if refresh_margin >= lifetime:
+            raise ValueError("The refresh margin must be shorter than the lifetime")
+        self._secret = secret
+        self._lifetime = lifetime
+        self._refresh_margin = refresh_margin
+        self._token = None
+        self._headers = None
+        self._refresh_at = 0.0
+        self._refresh_handle = None
+
+    @property
+    def secret(self):
+        return self._secret
+
+    @secret.setter
+    def secret(self, value):
+        if value != self._secret:
+            self._secret = value
+            self.invalidate()
+
+    @property
+    def token(self):
+        """Return a valid token"""
+        if self._token is None or time.monotonic() >= self._refresh_at:
+            self.refresh()
+        return self._token
+
+    @property
+    def headers(self):
+        """Return the headers with a valid token, these must not be changed"""
+        if self._token is None or time.monotonic() >= self._refresh_at:
+            self.refresh()
+        return self._headers
+
+    def refresh(self):
+        """Create a new token"""
+        if self._lifetime % 3600 == 0:
+            expires_in = f"{self._lifetime // 3600}h"
+        else:
+            expires_in = f"{self._lifetime}s"
+        self._token = jwt.encode(
+            {
+                "name": "my_application",
+                "exp": int(time.time()) + self._lifetime,
+            },
+            self._secret,
+            headers={"expiresIn": expires_in},
+        )
+        self._headers = {"Authorization": "Bearer " + self._token}
+        delay = self._lifetime - self._refresh_margin
+        self._refresh_at = time.monotonic() + delay
+        self._schedule_refresh(delay)
+        logger.debug("Created a new token")
+
+    def _schedule_refresh(self, delay):
+        if self._refresh_handle is not None:
+            self._refresh_handle.cancel()
+            self._refresh_handle = None
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # no event loop, the token is refreshed when it is requested
+            return
+        self._refresh_handle = loop.call_later(delay, self.refresh)
+
+    def invalidate(self):
+        """Drop the current token, a new one is created when it is requested"""
+        self.close()
+        self._token = None
+        self._headers = None
+
+    def close(self):
+        """Stop refreshing the token in the background"""
+        if self._refresh_handle is not None:
+            self._refresh_handle.cancel()
+            self._refresh_handle = None
+
+
 class DobissAPI:
     def __init__(self, secret, host, secure: bool):
         """Initialize dobiss api object"""
@@ -472,20 +2033,63 @@ class DobissAPI:
 
         self._host = host
         self._secure = secure
-        self._token = ""
-        self._exp_time = datetime.now()
-        self._secret = secret
+        self._token_manager = DobissTokenManager(secret)
         self._url = url
         self._ws_url = ws_url
         self._last_discovery = None
         self._force_discovery = False
         self._discovery_interval = DEF_DISCOVERY_INTERVAL
-        self._devices = []
+        self._registry = DobissRegistry()
+        self._devices = self._registry.devices
+        self._last_dispatch_count = 0
+        # last known status line of every module address
+        self._status_snapshot = {}
         self._stop_monitoring = True
         self._callbacks = set()
+        self._discovery_callbacks = []
+        self._group_hashes = {}
+        self._subject_hashes = {}
+        self._device_classes = dict(DOBISS_DEVICE_CLASSES)
+        self._device_class_cache = {}
+        # up devices for which no buddy was found
+        self._unpaired = set()
         self._session = None
+        # False when the session is shared, and closed by its owner
+        self._own_session = True
+        self._ssl_context = None
+        self._session_options = dict(
+            limit=DEF_POOL_LIMIT,
+            limit_per_host=DEF_POOL_LIMIT_PER_HOST,
+            keepalive_timeout=DEF_KEEPALIVE_TIMEOUT,
+            use_dns_cache=True,
+            ttl_dns_cache=DEF_DNS_CACHE_TTL,
+        )
         self._temp_calendars = []
         self._websocket_timeout = None
+        self._json_decoder = get_default_json_decoder()
+        self._websocket_heartbeat = DEF_WEBSOCKET_HEARTBEAT
+        self._reconnect_min_delay = DEF_RECONNECT_MIN_DELAY
+        self._reconnect_max_delay = DEF_RECONNECT_MAX_DELAY
+        self._resync_on_reconnect = True
+        self._connection_state = DOBISS_WS_DISCONNECTED
+        self._connection_callbacks = []
+        self._was_connected = False
+        self._reconnect_count = 0
+        self._action_queue = None
+        self._callback_dispatcher = None
+        self._poller = None
+        self._metrics = None
+        self._monitor_task = None
+        self._discovery_cache = None
+        self._discovery_checksum = None
+        self._revalidate_task = None
+        # history size and entity type of the devices keeping history
+        self._history = None
+        self._subscriptions = []
+        self._limiter = None
+        # timeout and entity type of the devices with optimistic updates
+        self._optimistic = None
+        self._refresh_coalescer = DobissRefreshCoalescer(self)
 
     @property
     def websocket_timeout(self):
@@ -496,11 +2100,84 @@ class DobissAPI:
     def websocket_timeout(self, value):
         self._websocket_timeout = value
 
+    @property
+    def json_decoder(self):
+        """The function used to parse json, from bytes or str"""
+        return self._json_decoder
+
+    @json_decoder.setter
+    def json_decoder(self, value):
+        self._json_decoder = value
+
+    @property
+    def websocket_heartbeat(self):
+        """The interval in seconds between websocket pings, None to disable heartbeats"""
+        return self._websocket_heartbeat
+
+    @websocket_heartbeat.setter
+    def websocket_heartbeat(self, value):
+        self._websocket_heartbeat = value
+
+    @property
+    def reconnect_min_delay(self):
+        """The delay in seconds before the first reconnect attempt"""
+        return self._reconnect_min_delay
+
+    @reconnect_min_delay.setter
+    def reconnect_min_delay(self, value):
+        if value <= 0 or value > self._reconnect_max_delay:
+            raise ValueError(
+                f"Reconnect delay must be between 0 and {self._reconnect_max_delay} seconds"
+            )
+        self._reconnect_min_delay = value
+
+    @property
+    def reconnect_max_delay(self):
+        """The maximum delay in seconds between reconnect attempts"""
+        return self._reconnect_max_delay
+
+    @reconnect_max_delay.setter
+    def reconnect_max_delay(self, value):
+        if value < self._reconnect_min_delay:
+            raise ValueError(
+                f"Reconnect delay must be at least {self._reconnect_min_delay} seconds"
+            )
+        self._reconnect_max_delay = value
+
+    @property
+    def resync_on_reconnect(self):
+        """Fetch the complete status after the websocket connection is restored"""
+        return self._resync_on_reconnect
+
+    @resync_on_reconnect.setter
+    def resync_on_reconnect(self, value):
+        self._resync_on_reconnect = value
+
+    @property
+    def registry(self):
+        """The registry holding all discovered devices"""
+        return self._registry
+
+    @property
+    def last_dispatch_count(self):
+        """The number of entities visited while dispatching the last status update"""
+        return self._last_dispatch_count
+
     @property
     def session(self):
-        """The interval in seconds between 2 consecutive device discovery"""
+        """The aiohttp session used to talk to the dobiss server"""
         return self._session
 
+    async def use_session(self, session):
+        """Use a session shared with other apis, it is not closed by end_session.
+        A session opened by this api before is closed."""
+        if session is self._session:
+            return
+        if self._session is not None and self._own_session and not self._session.closed:
+            await self._session.close()
+        self._session = session
+        self._own_session = session is None
+
     @property
     def host(self):
         return self._host
@@ -517,20 +2194,171 @@ class DobissAPI:
                 calendars.append(cal["name"])
         return calendars
 
+    @property
+    def action_queue(self):
+        """The queue used to batch actions, None if actions are sent immediately"""
+        return self._action_queue
+
+    def enable_action_queue(
+        self,
+        flush_window=DEF_ACTION_FLUSH_WINDOW,
+        max_in_flight=DEF_ACTION_MAX_IN_FLIGHT,
+    ):
+        """Collect actions during flush_window seconds before sending them, merge
+        repeated actions per address and channel (see DobissActionQueue), and send
+        at most max_in_flight requests concurrently"""
+        self._action_queue = DobissActionQueue(self, flush_window, max_in_flight)
+        return self._action_queue
+
+    async def disable_action_queue(self):
+        """Send all queued actions and go back to sending actions immediately"""
+        if self._action_queue is not None:
+            queue = self._action_queue
+            self._action_queue = None
+            await queue.flush()
+
+    @property
+    def callback_dispatcher(self):
+        """The dispatcher calling the entity callbacks, None if callbacks are called immediately"""
+        return self._callback_dispatcher
+
+    def enable_callback_dispatcher(
+        self, max_queue=DEF_CALLBACK_QUEUE_SIZE, debounce=None
+    ):
+        """Call the entity callbacks from a separate task instead of from the
+        websocket connection. At most max_queue entities wait for their callbacks,
+        and with a debounce window in seconds the callbacks of an entity are
+        called at most once per window."""
+        self._callback_dispatcher = DobissCallbackDispatcher(max_queue, debounce)
+        return self._callback_dispatcher
+
+    async def disable_callback_dispatcher(self):
+        """Go back to calling the entity callbacks immediately"""
+        if self._callback_dispatcher is not None:
+            dispatcher = self._callback_dispatcher
+            self._callback_dispatcher = None
+            await dispatcher.join()
+            await dispatcher.close()
+
+    @property
+    def metrics(self):
+        """The metrics collected by this api, None if disabled"""
+        return self._metrics
+
+    def enable_metrics(self, metrics=None):
+        """Collect metrics of requests, status updates, the websocket connection
+        and callbacks, into metrics or a new DobissMetrics"""
+        self._metrics = metrics if metrics is not None else DobissMetrics()
+        return self._metrics
+
+    def disable_metrics(self):
+        """Stop collecting metrics"""
+        self._metrics = None
+
+    @property
+    def limiter(self):
+        """The limiter of concurrent requests, None if requests are not limited"""
+        return self._limiter
+
+    def enable_request_limiter(self, limiter=None):
+        """Adapt the number of concurrent requests to the latency of the dobiss server,
+        and stop sending requests while the server fails. See DobissRequestLimiter."""
+        self._limiter = limiter if limiter is not None else DobissRequestLimiter()
+        return self._limiter
+
+    def disable_request_limiter(self):
+        self._limiter = None
+
+    def _limit(self):
+        if self._limiter is None:
+            return _NO_LIMIT
+        return self._limiter.request()
+
+    def _span(self, name, **labels):
+        if self._metrics is None:
+            return _NO_SPAN
+        return self._metrics.span(name, **labels)
+
+    @property
+    def poller(self):
+        """The poller used while the websocket connection is down, None if disabled"""
+        return self._poller
+
+    def enable_polling_fallback(
+        self,
+        min_interval=DEF_POLL_MIN_INTERVAL,
+        max_interval=DEF_POLL_MAX_INTERVAL,
+        hot_window=DEF_POLL_HOT_WINDOW,
+    ):
+        """Poll the status while the websocket connection is down, see DobissPoller"""
+        self.disable_polling_fallback()
+        self._poller = DobissPoller(self, min_interval, max_interval, hot_window)
+        if (
+            not self._stop_monitoring
+            and self._connection_state == DOBISS_WS_DISCONNECTED
+        ):
+            self._poller.start()
+        return self._poller
+
+    def disable_polling_fallback(self):
+        """Stop polling the status while the websocket connection is down"""
+        if self._poller is not None:
+            self._poller.stop()
+            self._poller = None
+
+    def configure_session(
+        self,
+        limit=DEF_POOL_LIMIT,
+        limit_per_host=DEF_POOL_LIMIT_PER_HOST,
+        keepalive_timeout=DEF_KEEPALIVE_TIMEOUT,
+        use_dns_cache=True,
+        ttl_dns_cache=DEF_DNS_CACHE_TTL,
+        ssl_context=None,
+    ):
+        """Configure the connection pool of the session.
+        limit: the maximum number of connections, 0 for no limit
+        limit_per_host: the maximum number of connections to the dobiss server, 0 for no limit
+        keepalive_timeout: the time in seconds idle connections are kept open
+        use_dns_cache, ttl_dns_cache: cache the resolved host for ttl_dns_cache seconds (None is forever)
+        ssl_context: the ssl context to use for secure connections, a default context is created if None
+        The configuration is used the next time a session is started."""
+        self._session_options = dict(
+            limit=limit,
+            limit_per_host=limit_per_host,
+            keepalive_timeout=keepalive_timeout,
+            use_dns_cache=use_dns_cache,
+            ttl_dns_cache=ttl_dns_cache,
+        )
+        self._ssl_context = ssl_context
+
+    def _create_connector(self):
+        if self._secure and self._ssl_context is None:
+            # create the ssl context once, and reuse it for every new session
+            self._ssl_context = ssl.create_default_context()
+        return aiohttp.TCPConnector(
+            ssl=self._ssl_context if self._secure else True,
+            **self._session_options,
+        )
+
     def start_session(self):
         if not self._session or self._session.closed:
-            self._session = aiohttp.ClientSession(raise_for_status=True)
+            self._session = aiohttp.ClientSession(
+                connector=self._create_connector(), raise_for_status=True
+            )
+            self._own_session = True
         return self._session
 
     async def end_session(self):
         if self._session:
-            if not self.session.closed:
+            if self._own_session and not self.session.closed:
                 await self._session.close()
             self._session = None
+            self._own_session = True
+        self._token_manager.close()
         return self._session
 
     async def auth_check(self):
-        headers = {"Authorization": "Bearer " + self.get_token()}
+        headers = self._token_manager.headers
         auth_ok = False
         try:
             self.start_session()
@@ -541,8 +2369,6 @@ class DobissAPI:
                     auth_ok = True
         except Exception as error:
             logger.exception(f"Äuthenticating Dobiss failed: {repr(error)}")
-        finally:
-            await self._session.close()
         return auth_ok
 
     async def get_apikey(self):
@@ -554,25 +2380,20 @@ class DobissAPI:
                 if response and response.status == 200:
                     apikey_data = await response.json()
                     logger.debug(f"apikey response: {apikey_data}")
-                    self._secret = apikey_data["jwt_secret"]
+                    self._token_manager.secret = apikey_data["jwt_secret"]
                     get_apikey_ok = True
         except Exception as error:
             logger.exception(f"Get APIKey Dobiss failed: {repr(error)}")
-        finally:
-            await self._session.close()
         return get_apikey_ok
 
+    @property
+    def token_manager(self):
+        """The token manager creating the tokens for the Dobiss server"""
+        return self._token_manager
+
     def get_token(self):
         """Request a token to use in a request to the Dobiss server"""
-        if self._exp_time < datetime.now() + timedelta(hours=20):
-            # get new token
-            self._token = jwt.encode(
-                {"name": "my_application"},
-                self._secret,
-                headers={"expiresIn": "24h"},
-            )
-            self._exp_time = datetime.now() + timedelta(hours=20)
-        return self._token
+        return self._token_manager.token
 
     @property
     def discovery_interval(self):
@@ -596,35 +2417,338 @@ class DobissAPI:
             return True
         return False
 
+    def events(
+        self, max_queue=DEF_EVENT_QUEUE_SIZE, overflow=DOBISS_OVERFLOW_DROP_OLDEST
+    ):
+        """Return a new DobissEventSubscription, an async iterator over the DobissEvent
+        of every state change. Close the subscription when done."""
+        subscription = DobissEventSubscription(self, max_queue, overflow)
+        self._subscriptions.append(subscription)
+        return subscription
+
+    def remove_subscription(self, subscription):
+        if subscription in self._subscriptions:
+            self._subscriptions.remove(subscription)
+
+    @property
+    def has_subscribers(self):
+        return bool(self._subscriptions)
+
+    async def publish_event(self, event):
+        """Pass an event to all subscriptions"""
+        for subscription in list(self._subscriptions):
+            await subscription.put(event)
+
+    @staticmethod
+    def _in_state(entity, target):
+        """True if the cached state of entity matches target"""
+        if isinstance(entity, DobissTempSensor):
+            if isinstance(target, str):
+                return entity.calendar == target
+            return entity.asked is not None and entity.asked == float(target)
+        if entity.value is None:
+            # unknown state, always send the command
+            return False
+        if not target:
+            return entity.value == 0
+        if entity.dimmable and type(target) == int:
+            return entity.value == target
+        return entity.is_on
+
+    @staticmethod
+    async def _apply_target(entity, target):
+        if isinstance(entity, DobissTempSensor):
+            if isinstance(target, str):
+                calendars = entity._dobiss.temp_calendars or []
+                if not any(cal["name"] == target for cal in calendars):
+                    # set_preset_mode would silently send nothing
+                    raise ValueError(f"Unknown preset {target} for {entity.name}")
+                await entity.set_preset_mode(target)
+            else:
+                await entity.set_temperature(float(target))
+        elif not isinstance(entity, DobissOutput):
+            raise TypeError(f"{entity.name} is no output or temperature sensor")
+        elif not target:
+            await entity.turn_off()
+        elif entity.dimmable and type(target) == int:
+            await entity.turn_on(brightness=target)
+        else:
+            await entity.turn_on()
+
+    async def apply_state(self, targets, max_parallel=DEF_APPLY_MAX_PARALLEL):
+        """Bring entities in the requested state, sending commands only for entities
+        not in that state according to their last known status.
+        targets maps entities or object ids to a target:
+            outputs: True/False for on/off, or an int brightness for dimmers (0 is off)
+            temperature sensors: a temperature, or the name of a preset
+        At most max_parallel commands are sent at the same time.
+        Returns a dict object id -> DobissApplyResult."""
+        results = {}
+        changes = []
+        for key, target in targets.items():
+            entity = (
+                key if isinstance(key, DobissEntity) else self.get_device_by_id(key)
+            )
+            if entity is None:
+                results[key] = DobissApplyResult(None, target, DOBISS_APPLY_NOT_FOUND)
+            elif self._in_state(entity, target):
+                results[entity.object_id] = DobissApplyResult(
+                    entity, target, DOBISS_APPLY_UNCHANGED
+                )
+            else:
+                # filled in when the command is done, keeping the order of targets
+                results[entity.object_id] = None
+                changes.append((entity, target))
+        semaphore = asyncio.Semaphore(max_parallel)
+
+        async def apply(entity, target):
+            async with semaphore:
+                try:
+                    await self._apply_target(entity, target)
+                except Exception as error:
+                    logger.warning(
+                        f"Setting {entity.name} to {target} failed: {repr(error)}"
+                    )
+                    return DobissApplyResult(entity, target, DOBISS_APPLY_FAILED, error)
+                return DobissApplyResult(entity, target, DOBISS_APPLY_SENT)
+
+        for result in await asyncio.gather(
+            *(apply(entity, target) for entity, target in changes)
+        ):
+            results[result.entity.object_id] = result
+        logger.debug(
+            f"Applied state: {len(changes)} of {len(targets)} entities needed a command"
+        )
+        return results
+
+    def enable_optimistic_updates(self, timeout=DEF_OPTIMISTIC_TIMEOUT, dev_type=None):
+        """Show the expected value of outputs of dev_type as soon as they are turned on
+        or off, before the dobiss server confirms it. The value is rolled back when the
+        expected state is not confirmed within timeout seconds, or the action fails.
+        dev_type None applies to all outputs."""
+        self._optimistic = (timeout, dev_type or DobissOutput)
+
+    def disable_optimistic_updates(self):
+        self._optimistic = None
+
+    def get_optimistic_timeout(self, entity):
+        """Return the optimistic update timeout of entity, None if disabled"""
+        if self._optimistic is None or not isinstance(entity, self._optimistic[1]):
+            return None
+        return self._optimistic[0]
+
+    def enable_history(self, size=DEF_HISTORY_SIZE, dev_type=None):
+        """Keep the history of the last size values of all devices of dev_type,
+        including devices discovered later. dev_type None keeps the history of all devices.
+        """
+        self._history = (size, dev_type or DobissEntity)
+        for dev in self._registry.get_by_type(self._history[1]):
+            dev.enable_history(size)
+
+    def disable_history(self):
+        if self._history is not None:
+            for dev in self._registry.get_by_type(self._history[1]):
+                dev.disable_history()
+        self._history = None
+
+    @property
+    def discovery_cache(self):
+        """The file holding the last discovery, None if disabled"""
+        return self._discovery_cache
+
+    def enable_discovery_cache(self, path):
+        """Store every discovery in the file at path. On start, discovery restores the
+        devices from this file, and revalidates them against the dobiss server in the
+        background, so the devices are available without waiting for the server."""
+        self._discovery_cache = path
+
+    def disable_discovery_cache(self):
+        """Stop storing and restoring the discovery"""
+        self._discovery_cache = None
+        if self._revalidate_task is not None:
+            self._revalidate_task.cancel()
+            self._revalidate_task = None
+
+    @staticmethod
+    def _discovery_checksum_of(data):
+        # a stable checksum: the builtin hash is salted differently in every process
+        return hashlib.sha256(
+            json.dumps(data, sort_keys=True, separators=(",", ":")).encode("utf-8")
+        ).hexdigest()
+
+    def _read_discovery_cache(self, path):
+        """returns the discovery stored in path, or None if it is missing, outdated or corrupt"""
+        try:
+            with open(path, "rb") as cache_file:
+                cache = json.loads(cache_file.read())
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as error:
+            logger.warning(f"Discovery cache {path} can not be read: {repr(error)}")
+            return None
+        if (
+            type(cache) != dict
+            or cache.get("version") != DISCOVERY_CACHE_VERSION
+            or cache.get("host") != self._host
+        ):
+            logger.debug(f"Discovery cache {path} is outdated")
+            return None
+        discovery = cache.get("discovery")
+        checksum = cache.get("checksum")
+        if discovery is None or checksum != self._discovery_checksum_of(discovery):
+            logger.warning(f"Discovery cache {path} is corrupt")
+            return None
+        self._discovery_checksum = checksum
+        return discovery
+
+    def _write_discovery_cache(self, path, discovery, checksum):
+        cache = {
+            "version": DISCOVERY_CACHE_VERSION,
+            "host": self._host,
+            "checksum": checksum,
+            "discovery": discovery,
+        }
+        # write to a temporary file first, so a crash never leaves a partial cache
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as cache_file:
+                json.dump(cache, cache_file, separators=(",", ":"))
+            os.replace(tmp_path, path)
+        except OSError as error:
+            logger.warning(f"Discovery cache {path} can not be written: {repr(error)}")
+
+    async def _store_discovery(self, discovery):
+        path = self._discovery_cache
+        if path is None:
+            return
+        checksum = self._discovery_checksum_of(discovery)
+        if checksum == self._discovery_checksum:
+            return
+        self._discovery_checksum = checksum
+        await asyncio.get_running_loop().run_in_executor(
+            None, self._write_discovery_cache, path, discovery, checksum
+        )
+
+    async def _restore_discovery(self):
+        """restore the devices from the discovery cache, and start revalidating them,
+        returns True when restored"""
+        path = self._discovery_cache
+        discovery = await asyncio.get_running_loop().run_in_executor(
+            None, self._read_discovery_cache, path
+        )
+        if self._revalidate_task is not None:
+            # restored by a concurrent discovery call
+            return True
+        if discovery is None or self._last_discovery:
+            return False
+        logger.debug(f"Discovery restored from {path}")
+        self._get_dobiss_devices(discovery)
+        self._revalidate_task = asyncio.ensure_future(self._revalidate_discovery())
+        return True
+
+    async def _revalidate_discovery(self):
+        try:
+            self._force_discovery = True
+            await self.discovery()
+        except Exception as error:
+            logger.warning(
+                f"Revalidating the cached discovery failed, retrying at the next discovery: {repr(error)}"
+            )
+        finally:
+            self._revalidate_task = None
+
     # if discovery is called before that configured polling interval has passed
     # it return cached data retrieved by previous successful call
     async def discovery(self):
+        if self._revalidate_task is not None:
+            if self._revalidate_task is not asyncio.current_task():
+                # the restored devices are being revalidated
+                return self._devices
+        elif (
+            self._discovery_cache is not None
+            and not self._last_discovery
+            and not self._devices
+            and await self._restore_discovery()
+        ):
+            return self._devices
         if self._call_discovery():
             try:
-                headers = {"Authorization": "Bearer " + self.get_token()}
+                headers = self._token_manager.headers
                 self.start_session()
-                response = await self._session.get(
-                    self._url + "discover", headers=headers
-                )
-                if response and response.status == 200:
-                    discovered_devices = await response.json()
+                async with self._limit():
+                    with self._span("dobiss_request_seconds", endpoint="discover"):
+                        async with self._session.get(
+                            self._url + "discover", headers=headers
+                        ) as response:
+                            if response and response.status == 200:
+                                discovered_devices = await self._read_json(response)
+                            else:
+                                discovered_devices = None
+                if discovered_devices is not None:
                     logger.debug(f"Discover response: {discovered_devices}")
                     self._get_dobiss_devices(discovered_devices)
+                    await self._store_discovery(discovered_devices)
             finally:
                 self._last_discovery = datetime.now()
         else:
             logger.debug("Discovery: Use cached info")
         return self._devices
 
-    async def status(self, address=None, channel=None):
+    @staticmethod
+    def _status_data(address=None, channel=None):
         data = {}
         if address is not None:
             data["address"] = address
         if channel is not None:
             data["channel"] = channel
-        headers = {"Authorization": "Bearer " + self.get_token()}
+        return data
+
+    async def _read_json(self, response):
+        """read the complete body of a response and parse it as json,
+        returns None when the body is empty"""
+        body = await response.read()
+        if not body.strip():
+            return None
+        return self._json_decoder(body)
+
+    async def status(self, address=None, channel=None):
+        """Request the status, returns the raw response which must be released by the caller.
+        Use status_json to get the parsed status instead."""
+        headers = self._token_manager.headers
         self.start_session()
-        return await self._session.get(self._url + "status", headers=headers, json=data)
+        async with self._limit():
+            return await self._session.get(
+                self._url + "status",
+                headers=headers,
+                json=self._status_data(address, channel),
+            )
+
+    async def status_json(self, address=None, channel=None):
+        """Request the status, and return the parsed json response"""
+        headers = self._token_manager.headers
+        self.start_session()
+        async with self._limit():
+            with self._span("dobiss_request_seconds", endpoint="status"):
+                async with self._session.get(
+                    self._url + "status",
+                    headers=headers,
+                    json=self._status_data(address, channel),
+                ) as response:
+                    return await self._read_json(response)
+
+    @property
+    def refresh_coalescer(self):
+        """The coalescer combining the status requests of single channels"""
+        return self._refresh_coalescer
+
+    async def refresh_status(self, address, channel):
+        """Request the status of a single channel. Concurrent requests for the same
+        channel share one request, and concurrent requests for several channels
+        of one module are combined into one request for the module."""
+        status = await asyncio.shield(self._refresh_coalescer.refresh(address, channel))
+        # keep the last known status up to date, or update_all would miss the next change
+        self._merge_status_snapshot(str(address), {str(channel): status})
+        return status
 
     async def action(
         self,
@@ -657,8 +2781,12 @@ class DobissAPI:
             else:
                 writedata["delayoff"]["value"] = min(round(delayoff / 60), 120)
                 writedata["delayoff"]["unit"] = "min"
-        logger.debug(f"Sending {writedata} to dobiss server")
-        await self.request(writedata)
+        if self._action_queue is not None:
+            logger.debug(f"Queueing {writedata} for dobiss server")
+            await self._action_queue.submit(writedata)
+        else:
+            logger.debug(f"Sending {writedata} to dobiss server")
+            await self.request_json(writedata)
 
     async def request(self, data):
         """send a raw json request. According to the API docs, it should look like:
@@ -685,241 +2813,735 @@ class DobissAPI:
             }
         }
         """
-        headers = {"Authorization": "Bearer " + self.get_token()}
+        headers = self._token_manager.headers
         self.start_session()
-        return await self._session.post(
-            self._url + "action", headers=headers, json=data
+        async with self._limit():
+            return await self._session.post(
+                self._url + "action", headers=headers, json=data
+            )
+
+    async def request_json(self, data):
+        """send a raw json request (see request), and return the parsed json response.
+        The response is read completely, so the connection is released immediately."""
+        headers = self._token_manager.headers
+        self.start_session()
+        async with self._limit():
+            with self._span("dobiss_request_seconds", endpoint="action"):
+                async with self._session.post(
+                    self._url + "action", headers=headers, json=data
+                ) as response:
+                    try:
+                        return await self._read_json(response)
+                    except ValueError:
+                        logger.debug(f"Action response is no json: {repr(response)}")
+                        return None
+
+    def register_device_class(
+        self, device_class, dobiss_type=None, icons_id=None, dimmable=None
+    ):
+        """Register the entity class used for discovered subjects with the given
+        type, icons_id and dimmable flag (True when the subject has a dimmable setting).
+        None matches any value, a device_class None ignores these subjects.
+        The classes are used from the next discovery on."""
+        self._device_classes[(dobiss_type, icons_id, dimmable)] = device_class
+        self._device_class_cache.clear()
+        self._group_hashes.clear()
+        self._subject_hashes.clear()
+        self._force_discovery = True
+
+    def get_device_class(self, dobiss_type, icons_id, dimmable):
+        """Return the entity class for a subject with the given type, icons_id and
+        dimmable flag, or None if these subjects are not supported"""
+        key = (dobiss_type, icons_id, dimmable)
+        try:
+            return self._device_class_cache[key]
+        except KeyError:
+            pass
+        device_class = None
+        # the most specific match wins, a match on icon goes before a match on type
+        for candidate in (
+            key,
+            (dobiss_type, icons_id, None),
+            (None, icons_id, dimmable),
+            (None, icons_id, None),
+            (dobiss_type, None, dimmable),
+            (dobiss_type, None, None),
+        ):
+            if candidate in self._device_classes:
+                device_class = self._device_classes[candidate]
+                break
+        self._device_class_cache[key] = device_class
+        return device_class
+
+    def _create_device(self, subject, groupname):
+        """create the entity for a discovered subject, returns None if the subject is not supported"""
+        device_class = self.get_device_class(
+            int(subject["type"]),
+            int(subject["icons_id"]),
+            subject["dimmable"] is not None,
         )
+        if device_class is None:
+            return None
+        if (
+            issubclass(device_class, DobissTempSensor)
+            and subject["name"] == "All zones"
+        ):
+            return None
+        return device_class(self, subject, groupname)
+
+    @staticmethod
+    def _discovery_hash(data):
+        return hash(json.dumps(data, sort_keys=True))
 
     def _get_dobiss_devices(self, discovered_devices):
         self._temp_calendars = discovered_devices["temp_calendars"]
-        new_devices = []
+        # object ids of all devices in this discovery
+        seen = set()
+        added = []
+        changed = {}
+        replaced = []
+        group_hashes = {}
         for group in discovered_devices["groups"]:
+            group_id = group["group"]["id"]
+            if group_id == 0:
+                # skip first group - nothing here which is not visible in one of the other groups below
+                continue
+            group_hash = self._discovery_hash(group)
+            cached = self._group_hashes.get(group_id)
+            if cached is not None and cached[0] == group_hash:
+                # nothing changed in this group since the previous discovery
+                group_hashes[group_id] = cached
+                seen.update(cached[1])
+                continue
+            groupname = group["group"]["name"]
+            group_ids = []
             for subject in group["subjects"]:
                 logger.debug(
-                    f"Group {group['group']['id']} Discovered {subject['name']}: addr {subject['address']}; \
+                    f"Group {group_id} Discovered {subject['name']}: addr {subject['address']}; \
                         channel {subject['channel']}; type {subject['type']}; icon {subject['icons_id']}"
                 )
-                if group["group"]["id"] != 0:
-                    # skip first group - nothing here which is not visible in one of the other groups below
-                    if str(subject["icons_id"]) == str(DOBISS_LIGHT) or str(
-                        subject["icons_id"]
-                    ) == str(
-                        DOBISS_TABLELIGHT
-                    ):  # check for lights
-                        new_devices.append(
-                            DobissLight(self, subject, group["group"]["name"])
-                        )
-                    elif str(subject["icons_id"]) in map(
-                        str, [DOBISS_RED, DOBISS_GREEN, DOBISS_BLUE, DOBISS_WHITE]
-                    ):
-                        new_devices.append(
-                            DobissLight(self, subject, group["group"]["name"])
-                        )
-                    elif str(subject["type"]) == str(
-                        DOBISS_TYPE_ANALOG
-                    ):  # other items connected to a 0-10V output
-                        new_devices.append(
-                            DobissAnalogOutput(self, subject, group["group"]["name"])
-                        )
-                    elif str(subject["type"]) == str(
-                        DOBISS_TYPE_RELAIS
-                    ):  # other items connected to a relais
-                        new_devices.append(
-                            DobissSwitch(self, subject, group["group"]["name"])
-                        )
-                    elif str(subject["type"]) == str(DOBISS_TYPE_INPUT):  # status input
-                        new_devices.append(
-                            DobissBinarySensor(self, subject, group["group"]["name"])
-                        )
-                    elif str(subject["type"]) == str(DOBISS_TYPE_FLAG):  # flags
-                        new_devices.append(
-                            DobissFlag(self, subject, group["group"]["name"])
-                        )
-                    elif str(subject["type"]) == str(DOBISS_TYPE_SCENARIO):  # scenarios
-                        new_devices.append(
-                            DobissScenario(self, subject, group["group"]["name"])
-                        )
-                    elif str(subject["type"]) == str(
-                        DOBISS_TYPE_AUTOMATION
-                    ):  # automations
-                        new_devices.append(
-                            DobissAutomation(self, subject, group["group"]["name"])
-                        )
-                    # elif str(subject["type"]) == "203": # logical conditions
-                    # 	new_devices.append(DobissSensor(self, subject, group["group"]["name"]))
-                    elif (
-                        str(subject["type"]) == str(DOBISS_TYPE_TEMPERATURE)
-                        and subject["name"] != "All zones"
-                    ):  # temperature
-                        new_devices.append(
-                            DobissTempSensor(self, subject, group["group"]["name"])
-                        )
-                    elif str(subject["type"]) == str(
-                        DOBISS_TYPE_NXT
-                    ):  # lightcell or input contact
-                        if str(subject["icons_id"]) == str(DOBISS_LIGHTSENSOR):
-                            new_devices.append(
-                                DobissLightSensor(self, subject, group["group"]["name"])
-                            )
-                        elif str(subject["icons_id"]) == str(DOBISS_INPUTSTATUS):
-                            new_devices.append(
-                                DobissBinarySensor(
-                                    self, subject, group["group"]["name"]
-                                )
-                            )
-                        # other things connected to dobiss NXT directly?? In demo there are screens etc
-                        elif (
-                            str(subject["icons_id"]) == str(DOBISS_UP)
-                            or str(subject["icons_id"]) == str(DOBISS_DOWN)
-                            or str(subject["icons_id"]) == str(DOBISS_GARAGE)
-                            or str(subject["icons_id"]) == str(DOBISS_DOOR)
-                            or str(subject["icons_id"]) == str(DOBISS_GATE)
-                            or str(subject["icons_id"]) == str(DOBISS_VENTILATION)
-                            or str(subject["icons_id"]) == str(DOBISS_HEATING)
-                        ):
-                            if subject["dimmable"] is not None:
-                                new_devices.append(
-                                    DobissAnalogOutput(
-                                        self, subject, group["group"]["name"]
-                                    )
-                                )
-                            else:
-                                new_devices.append(
-                                    DobissSwitch(self, subject, group["group"]["name"])
-                                )
-        for dev in new_devices:
-            existing_dev = self.get_device_by_id(dev.object_id)
-            if existing_dev:
-                existing_dev.update_from_discovery(dev)
-            else:
-                # a new device - add this to the list
-                self._devices.append(dev)
-
-        def get_buddy_name(s):
-            buddy_pairs = [(" op", " neer"), (" open", " dicht")]
-            for suffix, buddysuffix in buddy_pairs:
-                if s.endswith(suffix):
-                    buddyname = f"{s[:-len(suffix)]}{buddysuffix}"
-                    return buddyname
-            return s
-
-        # search for buddies
-        for device in self._devices:
-            if device.icons_id == DOBISS_UP:
-                # look for a corresponding buddy
-                # starting from dobiss NXT 3.0, there is a lock field that points to the buddy
+                object_id = "dobissid_{}_{}".format(
+                    int(subject["address"]), int(subject["channel"])
+                )
+                subject_hash = self._discovery_hash([groupname, subject])
                 if (
-                    "settings" in device.attributes
-                    and "locks" in device.attributes["settings"]
-                    and device.attributes["settings"]["locks"] is not None
+                    self._subject_hashes.get(object_id) == subject_hash
+                    and object_id in self._registry
                 ):
-                    buddy_channel = device.attributes["settings"]["locks"][0]
-                    for buddy in self._devices:
-                        if (
-                            buddy._channel == buddy_channel
-                            and buddy._address == device._address
-                        ):
-                            buddy.set_buddy(device)
-                            device.set_buddy(buddy)
-                            logger.debug(f"buddy for {device.name} found")
-                if device.buddy is None:
-                    buddyname = get_buddy_name(device.name)
-                    for buddy in self._devices:
-                        if buddy.name == buddyname and buddy.icons_id == DOBISS_DOWN:
-                            # we found a buddy
-                            buddy.set_buddy(device)
-                            device.set_buddy(buddy)
-                            logger.debug(f"buddy for {device.name} found")
-                if not device._buddy:
-                    logger.warn(f"No buddy for {device.name} found")
+                    # this subject did not change
+                    seen.add(object_id)
+                    group_ids.append(object_id)
+                    continue
+                dev = self._create_device(subject, groupname)
+                if dev is None:
+                    continue
+                seen.add(object_id)
+                group_ids.append(object_id)
+                self._subject_hashes[object_id] = subject_hash
+                existing_dev = self._registry.get(object_id)
+                if existing_dev and type(existing_dev) is not type(dev):
+                    # the subject is now a different kind of device, replace it
+                    self._registry.remove(object_id)
+                    replaced.append(existing_dev)
+                    existing_dev = None
+                if existing_dev:
+                    old_groupname = existing_dev.groupname
+                    existing_dev.update_from_discovery(dev)
+                    self._registry.regroup(existing_dev, old_groupname)
+                    changed[object_id] = existing_dev
+                else:
+                    # a new device - add this to the registry
+                    if self._history is not None and isinstance(dev, self._history[1]):
+                        dev.enable_history(self._history[0])
+                    self._registry.add(dev)
+                    added.append(dev)
+            group_hashes[group_id] = (group_hash, group_ids)
+        self._group_hashes = group_hashes
+
+        # remove the devices that are no longer discovered
+        removed = replaced
+        for dev in list(self._devices):
+            if dev.object_id not in seen:
+                self._registry.remove(dev.object_id)
+                self._subject_hashes.pop(dev.object_id, None)
+                removed.append(dev)
+        changed = list(changed.values())
+        for dev in added:
+            # make sure the next update_all sends the status of new devices
+            self._status_snapshot.pop(str(dev.address), None)
+
+        # search for buddies, only for the devices that changed
+        repair = added + changed
+        for dev in removed:
+            self._unpaired.discard(dev.object_id)
+            if dev.buddy is not None and dev.buddy.buddy is dev:
+                dev.buddy.set_buddy(None)
+                repair.append(dev.buddy)
+        if any(dev.icons_id != DOBISS_UP for dev in added + changed):
+            # a new or changed device can be the buddy of an unpaired device
+            repair.extend(
+                dev
+                for dev in self._devices
+                if dev.icons_id == DOBISS_UP and dev.buddy is None
+            )
+        self._pair_buddies(repair)
+
+        if added or removed or changed:
+            logger.debug(
+                f"Discovery: {len(added)} added, {len(removed)} removed, {len(changed)} changed"
+            )
+            for callback in self._discovery_callbacks:
+                callback(added, removed, changed)
 
         return self._devices
 
-    def get_devices_by_type(self, dev_type):
-        device_list = []
+    @staticmethod
+    def _get_buddy_name(s):
+        buddy_pairs = [(" op", " neer"), (" open", " dicht")]
+        for suffix, buddysuffix in buddy_pairs:
+            if s.endswith(suffix):
+                buddyname = f"{s[:-len(suffix)]}{buddysuffix}"
+                return buddyname
+        return s
+
+    def _pair_buddies(self, devices):
+        """search buddies for the up devices in devices"""
+        up_devices = [device for device in devices if device.icons_id == DOBISS_UP]
+        if not up_devices:
+            return
+        down_by_name = {}
         for device in self._devices:
-            if isinstance(device, dev_type):
-                device_list.append(device)
-        return device_list
+            if device.icons_id == DOBISS_DOWN:
+                down_by_name[device.name] = device
+        for device in up_devices:
+            # look for a corresponding buddy
+            # starting from dobiss NXT 3.0, there is a lock field that points to the buddy
+            buddy = None
+            settings = device.get_attribute("settings")
+            if settings and settings.get("locks") is not None:
+                buddy = self._registry.get_by_address(
+                    device.address, settings["locks"][0]
+                )
+            if buddy is None:
+                buddy = down_by_name.get(self._get_buddy_name(device.name))
+            if buddy is not None:
+                if device.buddy is not None and device.buddy is not buddy:
+                    if device.buddy.buddy is device:
+                        device.buddy.set_buddy(None)
+                buddy.set_buddy(device)
+                device.set_buddy(buddy)
+                self._unpaired.discard(device.object_id)
+                logger.debug(f"buddy for {device.name} found")
+            elif device.buddy is None and device.object_id not in self._unpaired:
+                # only warn once for every device without buddy
+                self._unpaired.add(device.object_id)
+                logger.warning(f"No buddy for {device.name} found")
+
+    def register_discovery_callback(self, callback):
+        """Register callback, called as callback(added, removed, changed)
+        with the lists of devices that changed in a discovery."""
+        self._discovery_callbacks.append(callback)
+
+    def remove_discovery_callback(self, callback):
+        """Remove previously registered discovery callback."""
+        self._discovery_callbacks.remove(callback)
+
+    def get_devices_by_type(self, dev_type):
+        return self._registry.get_by_type(dev_type)
+
+    def get_devices_by_group(self, groupname):
+        return self._registry.get_by_group(groupname)
 
     def get_all_devices(self):
         return self._devices
 
     def get_device_by_id(self, dev_id):
-        for device in self._devices:
-            if device.object_id == dev_id:
-                return device
-        return None
-
-    async def update_from_status(self, status, force=False):
+        return self._registry.get(dev_id)
+
+    def get_device_by_address(self, address, channel):
+        return self._registry.get_by_address(address, channel)
+
+    @staticmethod
+    def get_module_line(address, status):
+        """Return the status line of the module at address, from the status of a
+        request for that address. The line is either keyed by the address, or not;
+        a dict line (e.g. the temperature zones) is keyed by channel."""
+        if type(status) == dict and str(address) in status:
+            return status[str(address)]
+        return status
+
+    @staticmethod
+    def _normalize_status(status):
         # looks like in dobiss NXT 3.20 status updates for the NXT module can come it without address.
         if type(status) == list and len(status) == 1:
             status = {"0": status[0]}
-        for e in self._devices:
-            await e.update_from_global(status, force)
+        return status
+
+    def _merge_status_snapshot(self, address, line):
+        """remember the status line of a module, a dict line can hold only some channels"""
+        previous = self._status_snapshot.get(address)
+        if type(line) == dict and type(previous) == dict:
+            previous.update(line)
+        elif type(line) == dict and type(previous) == list:
+            previous = list(previous)
+            for channel, value in line.items():
+                if not str(channel).isdigit() or int(channel) >= len(previous):
+                    # no longer a list of channels, start over
+                    previous = dict(line)
+                    break
+                previous[int(channel)] = value
+            self._status_snapshot[address] = previous
+        else:
+            self._status_snapshot[address] = line
+
+    def _get_status_delta(self, status):
+        """return the channels in status that differ from the last known status"""
+        status = self._normalize_status(status)
+        if not isinstance(status, dict):
+            return status
+        delta = {}
+        for address, line in status.items():
+            address = str(address)
+            previous = self._status_snapshot.get(address)
+            if previous == line:
+                # nothing changed in this module
+                continue
+            if type(line) == list and type(previous) == list:
+                delta[address] = {
+                    str(channel): value
+                    for channel, value in enumerate(line)
+                    if channel >= len(previous) or previous[channel] != value
+                }
+            elif type(line) == dict and type(previous) == dict:
+                delta[address] = {
+                    channel: value
+                    for channel, value in line.items()
+                    if channel not in previous or previous[channel] != value
+                }
+            else:
+                delta[address] = line
+        return delta
+
+    async def update_from_status(self, status, force=False):
+        if self._metrics is None:
+            await self._update_from_status(status, force)
+            return
+        with self._metrics.span("dobiss_status_dispatch_seconds"):
+            await self._update_from_status(status, force)
+        self._metrics.count(
+            "dobiss_status_dispatch_entities_total", self._last_dispatch_count
+        )
+
+    async def _update_from_status(self, status, force=False):
+        status = self._normalize_status(status)
+        visited = 0
+        if isinstance(status, dict):
+            for address, line in status.items():
+                address = str(address)
+                self._merge_status_snapshot(address, line)
+                channels = self._registry.get_channels(address)
+                if not channels:
+                    continue
+                if type(line) == dict and len(line) < len(channels):
+                    # only visit the entities of the channels in this line
+                    entities = [
+                        channels[int(channel)]
+                        for channel in line
+                        if str(channel).isdigit() and int(channel) in channels
+                    ]
+                else:
+                    # a copy, discovery can change the channels while callbacks run
+                    entities = list(channels.values())
+                for e in entities:
+                    visited += 1
+                    await e.update_from_line(line, force)
+        else:
+            logger.debug(f"Ignoring unexpected status update: {status}")
+        self._last_dispatch_count = visited
 
     async def update_all(self, force=False):
-        response = await self.status()
-        status = await response.json()
+        """Fetch the complete status, and update the entities whose status changed
+        since the last known status. With force, all entities are updated.
+        Returns the status that was pushed to the entities."""
+        status = await self.status_json()
         logger.debug("Status response: {}".format(status))
-        await self.update_from_status(status["status"], force)
+        if force:
+            status = self._normalize_status(status["status"])
+            await self.update_from_status(status, force)
+            return status
+        delta = self._get_status_delta(status["status"])
+        await self.update_from_status(delta)
+        return delta
+
+    @property
+    def connection_state(self):
+        """The state of the websocket connection: connecting, connected or disconnected"""
+        return self._connection_state
+
+    @property
+    def reconnect_count(self):
+        """The number of times the websocket connection was lost and set up again"""
+        return self._reconnect_count
+
+    def register_connection_callback(self, callback):
+        """Register callback, called as callback(state) when the state of the
+        websocket connection changes, callbacks can be coroutine functions."""
+        self._connection_callbacks.append(callback)
+
+    def remove_connection_callback(self, callback):
+        """Remove previously registered connection callback."""
+        self._connection_callbacks.remove(callback)
+
+    async def _set_connection_state(self, state):
+        if state == self._connection_state:
+            return
+        logger.debug(f"websocket connection {state}")
+        self._connection_state = state
+        if self._poller is not None:
+            if state == DOBISS_WS_CONNECTED or self._stop_monitoring:
+                self._poller.stop()
+            elif state == DOBISS_WS_DISCONNECTED:
+                self._poller.start()
+        for callback in list(self._connection_callbacks):
+            try:
+                result = callback(state)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as error:
+                logger.exception(f"Connection callback failed: {repr(error)}")
+
+    def _get_reconnect_delay(self, attempt):
+        """exponential backoff with jitter, between the min and max reconnect delay"""
+        # the exponent is capped, 2**attempt would overflow a float after a long outage
+        delay = min(
+            self._reconnect_max_delay,
+            self._reconnect_min_delay * (2 ** min(attempt, DEF_RECONNECT_MAX_EXPONENT)),
+        )
+        return random.uniform(self._reconnect_min_delay, delay)
+
+    async def _resync(self):
+        """fetch the complete status, to catch up on updates missed while disconnected"""
+        try:
+            await self.update_all()
+        except Exception as error:
+            logger.exception(f"Resync after reconnect failed: {repr(error)}")
+
+    async def _receive_from_websocket(self, ws):
+        while not self._stop_monitoring:
+            try:
+                msg = await ws.receive(timeout=self._websocket_timeout)
+                if msg.type not in (aiohttp.WSMsgType.TEXT, aiohttp.WSMsgType.BINARY):
+                    # websocket closed, or a heartbeat was missed
+                    logger.debug(f"websocket connection closed: {msg.type}")
+                    break
+                data = msg.data
+                if self._metrics is not None:
+                    self._metrics.count("dobiss_websocket_messages_total")
+                logger.debug(f"Received websocket communication: {data}")
+                if data:
+                    response = self._json_decoder(data)
+                    logger.debug(f"Status update pushed: {response}")
+                    if response is not None:
+                        await self.update_from_status(response)
+            except TimeoutError as error:
+                logger.exception(f"dobiss monitor timeout exception: {repr(error)}")
+                break
+            except TypeError as error:
+                logger.exception(f"dobiss monitor exception: {repr(error)}")
+                break
+            except ValueError as error:
+                logger.exception(f"dobiss monitor exception: {repr(error)}")
+            except asyncio.exceptions.CancelledError as error:
+                logger.debug(
+                    f"websocket connection cancelled - we must be stopping: {repr(error)}"
+                )
+                self._stop_monitoring = True
+                break
+            except Exception as error:
+                logger.exception(f"Status update exception: {repr(error)}")
+                break
 
     async def listen_for_dobiss(self):
+        loop = asyncio.get_running_loop()
+        attempt = 0
         while not self._stop_monitoring:
             logger.debug("registering for websocket connection")
-            headers = {"Authorization": "Bearer " + self.get_token()}
+            await self._set_connection_state(DOBISS_WS_CONNECTING)
+            headers = self._token_manager.headers
             self.start_session()
             try:
+                options = {"decode_text": False} if _WS_DECODE_TEXT else {}
                 ws = await self._session.ws_connect(
-                    self._ws_url, protocols=["wamp"], headers=headers
+                    self._ws_url,
+                    protocols=["wamp"],
+                    headers=headers,
+                    heartbeat=self._websocket_heartbeat,
+                    **options,
                 )
-                while not self._stop_monitoring:
-                    try:
-                        import json
-
-                        data = await ws.receive_str(timeout=self._websocket_timeout)
-                        logger.debug(f"Received websocket communication: {data}")
-                        # response = await ws.receive_json()
-                        if data:
-                            response = json.loads(data)
-                            logger.debug(f"Status update pushed: {response}")
-                            if response is not None:
-                                await self.update_from_status(response)
-                    except TimeoutError as error:
-                        logger.exception(
-                            f"dobiss monitor timeout exception: {repr(error)}"
-                        )
-                        if not ws.closed:
-                            await ws.close()
-                        break
-                    except TypeError as error:
-                        logger.exception(f"dobiss monitor exception: {repr(error)}")
-                        if not ws.closed:
-                            await ws.close()
-                        break
-                    except ValueError as error:
-                        logger.exception(f"dobiss monitor exception: {repr(error)}")
-                    except asyncio.exceptions.CancelledError as error:
-                        logger.debug(
-                            f"websocket connection cancelled - we must be stopping: {repr(error)}"
-                        )
-                        self._stop_monitoring = True
-                        break
-                    except Exception as error:
-                        logger.exception(f"Status update exception: {repr(error)}")
-                        if not ws.closed:
-                            await ws.close()
-                        break
             except Exception as error:
+                await self._set_connection_state(DOBISS_WS_DISCONNECTED)
+                delay = self._get_reconnect_delay(attempt)
+                attempt += 1
                 logger.exception(
-                    f"Failed to connect, waiting a bit before retrying: {repr(error)}"
+                    f"Failed to connect, waiting {delay:.1f} seconds before retrying: {repr(error)}"
                 )
-                await asyncio.sleep(10)
+                await asyncio.sleep(delay)
+                continue
+            connected_at = loop.time()
+            try:
+                await self._set_connection_state(DOBISS_WS_CONNECTED)
+                if self._was_connected:
+                    self._reconnect_count += 1
+                    if self._metrics is not None:
+                        self._metrics.count("dobiss_websocket_reconnects_total")
+                    if self._resync_on_reconnect:
+                        await self._resync()
+                self._was_connected = True
+                await self._receive_from_websocket(ws)
+            finally:
+                if not ws.closed:
+                    await ws.close()
+                await self._set_connection_state(DOBISS_WS_DISCONNECTED)
+            if self._stop_monitoring:
+                break
+            if loop.time() - connected_at > self._reconnect_max_delay:
+                # the connection was stable, start over with a short delay
+                attempt = 0
+            delay = self._get_reconnect_delay(attempt)
+            attempt += 1
+            logger.debug(
+                f"websocket connection lost, reconnecting in {delay:.1f} seconds"
+            )
+            await asyncio.sleep(delay)
+
+    @property
+    def monitor_task(self):
+        """The task listening for status updates, None if not monitoring"""
+        return self._monitor_task
 
     def stop_monitoring(self):
         self._stop_monitoring = True
+        if self._poller is not None:
+            self._poller.stop()
+        if self._monitor_task is not None:
+            if self._monitor_task is not asyncio.current_task():
+                self._monitor_task.cancel()
+            self._monitor_task = None
+
+    async def wait_stopped(self):
+        """Stop monitoring, and wait until the monitor task has finished"""
+        task = self._monitor_task
+        self.stop_monitoring()
+        if task is not None and task is not asyncio.current_task():
+            await asyncio.gather(task, return_exceptions=True)
 
     async def dobiss_monitor(self):
         self._stop_monitoring = False
-        asyncio.ensure_future(self.listen_for_dobiss())
+        if self._monitor_task is None or self._monitor_task.done():
+            self._monitor_task = asyncio.ensure_future(self.listen_for_dobiss())
+        return self._monitor_task
+
+
+class DobissManager:
+    """runs several dobiss controllers from one process. All controllers share one
+    connection pool, discovery is spread over the discovery interval instead of
+    hitting all controllers at once, and devices can be looked up over all
+    controllers.
+
+        manager = DobissManager()
+        await manager.add(DobissAPI(secret, host, False))
+        await manager.start()
+        ...
+        await manager.stop()
+    """
+
+    def __init__(
+        self,
+        discovery_interval=DEF_DISCOVERY_INTERVAL,
+        discovery_stagger=DEF_DISCOVERY_STAGGER,
+        limit=DEF_MANAGER_POOL_LIMIT,
+        limit_per_host=DEF_MANAGER_POOL_LIMIT_PER_HOST,
+        keepalive_timeout=DEF_KEEPALIVE_TIMEOUT,
+        ssl_context=None,
+    ):
+        if discovery_interval < MIN_DISCOVERY_INTERVAL:
+            raise ValueError(
+                f"Discovery interval below {MIN_DISCOVERY_INTERVAL} seconds is invalid"
+            )
+        self._controllers = {}
+        self._discovery_interval = discovery_interval
+        self._discovery_stagger = discovery_stagger
+        self._session_options = dict(
+            limit=limit,
+            limit_per_host=limit_per_host,
+            keepalive_timeout=keepalive_timeout,
+            use_dns_cache=True,
+            ttl_dns_cache=DEF_DNS_CACHE_TTL,
+        )
+        self._ssl_context = ssl_context
+        self._session = None
+        self._discovery_task = None
+        self._running = False
+
+    @property
+    def controllers(self):
+        """Return all controllers"""
+        return list(self._controllers.values())
+
+    @property
+    def session(self):
+        """The aiohttp session shared by all controllers"""
+        return self._session
+
+    @property
+    def running(self):
+        return self._running
+
+    @property
+    def discovery_interval(self):
+        """The interval in seconds between 2 consecutive discoveries of a controller"""
+        return self._discovery_interval
+
+    @discovery_interval.setter
+    def discovery_interval(self, val):
+        if val < MIN_DISCOVERY_INTERVAL:
+            raise ValueError(
+                f"Discovery interval below {MIN_DISCOVERY_INTERVAL} seconds is invalid"
+            )
+        self._discovery_interval = val
+
+    def get_controller(self, host):
+        """Return the controller for the given host, or None"""
+        return self._controllers.get(host)
+
+    async def start_session(self):
+        """Start the shared session, and let all controllers use it"""
+        if not self._session or self._session.closed:
+            if self._ssl_context is None:
+                self._ssl_context = ssl.create_default_context()
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    ssl=self._ssl_context, **self._session_options
+                ),
+                raise_for_status=True,
+            )
+        for dobiss in self._controllers.values():
+            await dobiss.use_session(self._session)
+        return self._session
+
+    async def end_session(self):
+        if self._session:
+            for dobiss in self._controllers.values():
+                await dobiss.end_session()
+            if not self._session.closed:
+                await self._session.close()
+            self._session = None
+
+    async def add(self, dobiss):
+        """Add a controller, it is started when the manager is running"""
+        if dobiss.host in self._controllers:
+            raise ValueError(f"A controller for {dobiss.host} was already added")
+        self._controllers[dobiss.host] = dobiss
+        if self._session is not None:
+            await dobiss.use_session(self._session)
+        if self._running:
+            await self._discover(dobiss)
+            await dobiss.dobiss_monitor()
+        return dobiss
+
+    async def remove(self, host):
+        """Stop and remove the controller for the given host, returns the controller"""
+        dobiss = self._controllers.pop(host, None)
+        if dobiss is not None:
+            await dobiss.wait_stopped()
+            await dobiss.end_session()
+        return dobiss
+
+    async def _discover(self, dobiss, delay=0):
+        if delay:
+            await asyncio.sleep(delay)
+        try:
+            await dobiss.discovery()
+        except Exception as error:
+            logger.exception(f"Discovery of {dobiss.host} failed: {repr(error)}")
+
+    async def discovery(self):
+        """Run discovery on all controllers, started discovery_stagger seconds apart"""
+        await self.start_session()
+        await asyncio.gather(
+            *(
+                self._discover(dobiss, i * self._discovery_stagger)
+                for i, dobiss in enumerate(list(self._controllers.values()))
+            )
+        )
+        return self.get_all_devices()
+
+    async def _run_discovery(self):
+        # discover one controller at a time, so every controller is discovered
+        # once per discovery interval without bursts of requests
+        index = 0
+        while True:
+            controllers = list(self._controllers.values())
+            await asyncio.sleep(self._discovery_interval / max(1, len(controllers)))
+            controllers = list(self._controllers.values())
+            if not controllers:
+                continue
+            dobiss = controllers[index % len(controllers)]
+            index += 1
+            dobiss._force_discovery = True
+            await self._discover(dobiss)
+
+    async def start(self):
+        """Discover and start monitoring all controllers"""
+        if self._running:
+            return
+        self._running = True
+        await self.discovery()
+        for dobiss in self._controllers.values():
+            await dobiss.dobiss_monitor()
+        self._discovery_task = asyncio.ensure_future(self._run_discovery())
+
+    async def stop(self):
+        """Stop monitoring all controllers, wait for their tasks and close the session"""
+        self._running = False
+        if self._discovery_task is not None:
+            self._discovery_task.cancel()
+            await asyncio.gather(self._discovery_task, return_exceptions=True)
+            self._discovery_task = None
+        await asyncio.gather(
+            *(dobiss.wait_stopped() for dobiss in self._controllers.values())
+        )
+        await self.end_session()
+
+    def get_all_devices(self):
+        """Return the devices of all controllers"""
+        devices = []
+        for dobiss in self._controllers.values():
+            devices.extend(dobiss.get_all_devices())
+        return devices
+
+    def get_devices_by_type(self, dev_type):
+        devices = []
+        for dobiss in self._controllers.values():
+            devices.extend(dobiss.get_devices_by_type(dev_type))
+        return devices
+
+    def get_devices_by_group(self, groupname):
+        devices = []
+        for dobiss in self._controllers.values():
+            devices.extend(dobiss.get_devices_by_group(groupname))
+        return devices
+
+    def get_device_by_id(self, host, dev_id):
+        """Return the device with the given object id on the controller for host, or None.
+        Object ids are only unique within one controller."""
+        dobiss = self._controllers.get(host)
+        if dobiss is None:
+            return None
+        return dobiss.get_device_by_id(dev_id)
+
+    def get_device_by_address(self, host, address, channel):
+        dobiss = self._controllers.get(host)
+        if dobiss is None:
+            return None
+        return dobiss.get_device_by_address(address, channel)
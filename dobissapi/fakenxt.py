@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+"""a fake dobiss NXT server, serving a synthetic installation over the local api.
+Useful to develop and benchmark without a real controller:
+
+    nxt = FakeNXT(modules=20, channels=12, push_rate=50)
+    host = await nxt.start()
+    dobiss = DobissAPI(nxt.secret, host, False)
+"""
+
+import asyncio
+import json
+import logging
+import random
+
+import jwt
+from aiohttp import web
+
+from .dobissapi import DOBISS_DOWN
+from .dobissapi import DOBISS_LIGHT
+from .dobissapi import DOBISS_PLUG
+from .dobissapi import DOBISS_TEMPERATURE
+from .dobissapi import DOBISS_TYPE_DALI
+from .dobissapi import DOBISS_TYPE_NXT
+from .dobissapi import DOBISS_TYPE_RELAIS
+from .dobissapi import DOBISS_TYPE_TEMPERATURE
+from .dobissapi import DOBISS_UP
+
+logger = logging.getLogger(__name__)
+
+DEF_FAKE_SECRET = "fake-nxt-secret-with-enough-bytes-for-hs256"
+
+
+class FakeNXT:
+    """a fake dobiss NXT with modules relais and dimmer modules of channels outputs,
+    screens up/down pairs on the NXT itself and zones temperature zones.
+    With push_rate, that many random status changes per second are pushed
+    over the websocket."""
+
+    def __init__(
+        self,
+        modules=4,
+        channels=12,
+        screens=2,
+        zones=2,
+        push_rate=0.0,
+        secret=DEF_FAKE_SECRET,
+        seed=None,
+    ):
+        self._modules = modules
+        self._channels = channels
+        self._screens = screens
+        self._zones = zones
+        self._push_rate = push_rate
+        self._secret = secret
+        self._random = random.Random(seed)
+        self._sockets = set()
+        self._runner = None
+        self._push_task = None
+        self.requests = {}
+        self.actions = []
+        self.pushed = 0
+        self.discovery = self._create_discovery()
+        self.status = self._create_status()
+
+    @property
+    def secret(self):
+        return self._secret
+
+    @property
+    def push_rate(self):
+        """The number of random status changes pushed per second"""
+        return self._push_rate
+
+    @push_rate.setter
+    def push_rate(self, value):
+        self._push_rate = value
+
+    def _create_discovery(self):
+        subjects = []
+        for module in range(1, self._modules + 1):
+            # every other module is a dimmer module
+            dimmer = module % 2 == 0
+            for channel in range(self._channels):
+                subjects.append(
+                    {
+                        "name": f"Output {module}.{channel}",
+                        "address": module,
+                        "channel": channel,
+                        "type": DOBISS_TYPE_DALI if dimmer else DOBISS_TYPE_RELAIS,
+                        "icons_id": DOBISS_LIGHT if dimmer else DOBISS_PLUG,
+                        "dimmable": dimmer,
+                    }
+                )
+        for screen in range(self._screens):
+            for offset, icons_id, suffix in (
+                (1, DOBISS_UP, "op"),
+                (2, DOBISS_DOWN, "neer"),
+            ):
+                subjects.append(
+                    {
+                        "name": f"Screen {screen} {suffix}",
+                        "address": 0,
+                        "channel": 2 * screen + offset,
+                        "type": DOBISS_TYPE_NXT,
+                        "icons_id": icons_id,
+                        "dimmable": None,
+                    }
+                )
+        for zone in range(1, self._zones + 1):
+            subjects.append(
+                {
+                    "name": f"Zone {zone}",
+                    "address": DOBISS_TEMPERATURE,
+                    "channel": zone,
+                    "type": DOBISS_TYPE_TEMPERATURE,
+                    "icons_id": DOBISS_TEMPERATURE,
+                    "dimmable": False,
+                }
+            )
+        # the first group holds everything, and is skipped by the api
+        return {
+            "temp_calendars": [{"id": 1, "name": "home"}, {"id": 2, "name": "away"}],
+            "groups": [
+                {"group": {"id": 0, "name": "All"}, "subjects": subjects},
+                {"group": {"id": 1, "name": "House"}, "subjects": subjects},
+            ],
+        }
+
+    def _create_status(self):
+        status = {}
+        for module in range(1, self._modules + 1):
+            status[str(module)] = [0] * self._channels
+        if self._screens:
+            status["0"] = [0] * (2 * self._screens + 1)
+        if self._zones:
+            status[str(DOBISS_TEMPERATURE)] = {
+                str(zone): {
+                    "status": None,
+                    "temp": "20.0",
+                    "asked": "20.0",
+                    "time": -30,
+                    "calendar": 1,
+                }
+                for zone in range(1, self._zones + 1)
+            }
+        return status
+
+    def _count(self, name):
+        self.requests[name] = self.requests.get(name, 0) + 1
+
+    def _authorized(self, request):
+        auth = request.headers.get("Authorization", "")
+        if not auth.startswith("Bearer "):
+            return False
+        try:
+            jwt.decode(auth[7:], self._secret, algorithms=["HS256"])
+        except jwt.PyJWTError:
+            return False
+        return True
+
+    async def _read_body(self, request):
+        if not request.can_read_body:
+            return {}
+        body = await request.read()
+        if not body.strip():
+            return {}
+        return json.loads(body)
+
+    async def _handle_discover(self, request):
+        self._count("discover")
+        if not self._authorized(request):
+            raise web.HTTPUnauthorized()
+        return web.json_response(self.discovery)
+
+    async def _handle_status(self, request):
+        self._count("status")
+        if not self._authorized(request):
+            raise web.HTTPUnauthorized()
+        data = await self._read_body(request)
+        if "address" not in data:
+            return web.json_response({"status": self.status})
+        line = self.status.get(str(data["address"]))
+        if line is None:
+            raise web.HTTPNotFound()
+        if "channel" not in data:
+            return web.json_response({"status": {str(data["address"]): line}})
+        if type(line) == list:
+            return web.json_response({"status": line[int(data["channel"])]})
+        return web.json_response({"status": line[str(data["channel"])]})
+
+    async def _handle_action(self, request):
+        self._count("action")
+        if not self._authorized(request):
+            raise web.HTTPUnauthorized()
+        data = await self._read_body(request)
+        self.actions.append(data)
+        address = str(data["address"])
+        channel = data["channel"]
+        line = self.status.get(address)
+        if line is None:
+            raise web.HTTPNotFound()
+        if type(line) == dict:
+            zone = line[str(channel)]
+            if data["action"] == 1 and "option1" in data:
+                zone["asked"] = str(data["option1"] / 10 + 5)
+            zone["time"] = -30 if data["action"] == 0 else data.get("option2", 0) * 15
+        else:
+            if data["action"] == 0:
+                value = 0
+            elif data["action"] == 2:
+                value = 0 if line[channel] else 1
+            else:
+                value = data.get("option1", 1)
+            line[channel] = value
+        await self.push({address: line})
+        return web.json_response({"status": "ok"})
+
+    async def _handle_jwtsecret(self, request):
+        self._count("jwtsecret")
+        return web.json_response({"jwt_secret": self._secret})
+
+    async def _handle_socket(self, request):
+        self._count("socket")
+        if not self._authorized(request):
+            raise web.HTTPUnauthorized()
+        ws = web.WebSocketResponse(protocols=["wamp"])
+        await ws.prepare(request)
+        self._sockets.add(ws)
+        try:
+            async for _ in ws:
+                pass
+        finally:
+            self._sockets.discard(ws)
+        return ws
+
+    async def push(self, status):
+        """Push a status update to all websocket connections"""
+        if not self._sockets:
+            return
+        data = json.dumps(status)
+        self.pushed += 1
+        for ws in list(self._sockets):
+            try:
+                await ws.send_str(data)
+            except ConnectionError:
+                self._sockets.discard(ws)
+
+    def random_change(self):
+        """Change a random output to a new value, returns the changed status line"""
+        address = str(self._random.randint(1, self._modules))
+        line = self.status[address]
+        channel = self._random.randrange(len(line))
+        if int(address) % 2 == 0:
+            line[channel] = (line[channel] + self._random.randint(1, 100)) % 101
+        else:
+            line[channel] = 0 if line[channel] else 1
+        return {address: line}
+
+    async def _push_random(self):
+        loop = asyncio.get_running_loop()
+        next_push = loop.time()
+        while True:
+            if self._push_rate <= 0:
+                await asyncio.sleep(0.1)
+                next_push = loop.time()
+                continue
+            await self.push(self.random_change())
+            next_push += 1 / self._push_rate
+            await asyncio.sleep(max(0, next_push - loop.time()))
+
+    async def close_sockets(self):
+        """Close all websocket connections, as if the connection was lost"""
+        for ws in list(self._sockets):
+            await ws.close()
+
+    async def start(self, host="127.0.0.1", port=0):
+        """Start the server, returns host:port to pass to DobissAPI"""
+        app = web.Application()
+        app.router.add_get("/api/local/discover", self._handle_discover)
+        app.router.add_get("/api/local/status", self._handle_status)
+        app.router.add_post("/api/local/action", self._handle_action)
+        app.router.add_get("/api/local/jwtsecret", self._handle_jwtsecret)
+        app.router.add_get("/sockets/api", self._handle_socket)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self._push_task = asyncio.ensure_future(self._push_random())
+        logger.debug(f"Fake NXT listening on {host}:{port}")
+        return f"{host}:{port}"
+
+    async def stop(self):
+        """Stop the server"""
+        if self._push_task is not None:
+            self._push_task.cancel()
+            self._push_task = None
+        await self.close_sockets()
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
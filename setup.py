@@ -20,4 +20,7 @@ setup(
         "pyjwt",
         "aiohttp",
     ],
+    extras_require={
+        "fast": ["orjson"],
+    },
 )